@@ -1,38 +1,32 @@
 #!/usr/bin/env python
 
 # Configure logging before importing anything!
-import yaml
-import logging
-import logging.config
-
-import os
-from dotenv import load_dotenv
-load_dotenv()
-loggingconfig = os.getenv("LOGCONFIG")
-
-print(f"Starting configuring logging using: {loggingconfig}")
-with open(loggingconfig) as logyaml:
-    logconfig = yaml.safe_load(logyaml)
-logging.config.dictConfig(logconfig)
+from config import configurelogging, loadsettings
+configurelogging()
 
 # Now do other stuff
 
-from dotenv import load_dotenv
-
-load_dotenv()
+import os
 
 import typing as t
 from apiflask import APIFlask, HTTPTokenAuth, HTTPError
-from apiflask.fields import Integer, String
+from apiflask.fields import Integer, String, Float, List, Dict
 from apiflask.schemas import Schema
 import secrets
 import importlib
-from collections.abc import Mapping
 
 from apispec import BasePlugin
-from rabbitlistener import RabbitListener
+from rabbitlistener import createlistener
 from queue import Queue
-from cacher import ValkeyCacher
+from cacher import ValkeyCacher, LocalCacher, CacheBackendError, preheatcache
+from broadcaster import Broadcaster, TooManySubscribers
+from tokenauth import TokenTable
+from flask import Response, stream_with_context, request, g
+import time
+import metrics
+from datetime import datetime, timezone
+from queue import Empty
+import json
 
 # logger = logging.getLogger("mymain")
 # logger.debug("Mymain module debug")
@@ -48,8 +42,11 @@ from cacher import ValkeyCacher
 
 mastertoken = os.getenv("MASTERTOKEN")
 openapi = os.getenv("OPENAPI") == "1"
+# With INGEST=0 this process only serves the API; ingestion runs separately in ingest.py
+ingest = os.getenv("INGEST", "1") == "1"
 
 mycacher = None
+mybroadcaster = None
 
 print(f"Openapi = {openapi}")
 
@@ -64,19 +61,70 @@ app.secret_key = secrets.token_bytes(32)
 
 auth = HTTPTokenAuth(scheme='bearer')
 
-userbase = {}
-rolebase = {}
+@app.before_request
+def starttimer():
+    g.requeststart = time.perf_counter()
+
+@app.after_request
+def recordlatency(response):
+    if 'requeststart' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.httplatency.labels(request.method, route, response.status_code).observe(time.perf_counter() - g.requeststart)
+    return response
+
+@app.get("/metrics")
+@app.doc(hide=True)
+def _metrics():
+    output, contenttype = metrics.exposition()
+    return Response(output, mimetype=contenttype)
+
+def ingeststatus():
+    # Without ingestion in this process, use the status published by ingest.py
+    if ingest:
+        return app.listeners['rabbitqueues'].status()
+    try:
+        return mycacher.getstatus('ingest')
+    except Exception:
+        app.logger.exception("Unable to read ingest status")
+        return None
+
+@app.get("/health")
+@app.doc(hide=True)
+def _health():
+    # Liveness: with ingestion, every queue must still have its supervisor thread
+    status = ingeststatus()
+    alive = status['alive'] if ingest else True
+    return { 'alive': alive, 'ingest': status }, 200 if alive else 503
+
+@app.get("/ready")
+@app.doc(hide=True)
+def _ready():
+    status = ingeststatus()
+    ready = status is not None and status['ready']
+    return { 'ready': ready, 'ingest': status }, 200 if ready else 503
+
+tokentable = TokenTable([])
 
 @auth.verify_token
 def verify_token(token):
-    app.logger.debug(f"Verifying token {token} from userbase {userbase}")
-    return userbase[token] if token in userbase else None
+    # Stacked auth decorators verify the same token more than once per request
+    if 'authtoken' in g and g.authtoken == token:
+        return g.authuser
+    g.authtoken = token
+    g.authuser = tokentable.lookup(token) if token else None
+    return g.authuser
     
 @auth.get_user_roles
 def get_user_roles(user):
-    app.logger.debug(f"Getting roles for {user} from rolebase {rolebase}")
-    return rolebase[user] if user in rolebase else None
+    # flask-httpauth only treats lists and tuples as a collection of roles
+    return tuple(user.roles)
     
+@app.errorhandler(CacheBackendError)
+def cacheunavailable(error):
+    # Valkey being unreachable is not the same as a value that is not cached (404)
+    app.logger.warning("Cache unavailable: %s", error)
+    return { 'detail': {}, 'message': 'Cache unavailable' }, 503, { 'Retry-After': '5' }
+
 
 cache = { 'test': 'value'}
 
@@ -90,16 +138,170 @@ def readcache(key):
 def _listcategories():
     return mycacher.listcategories()
 
+class EntryListQuery(Schema):
+    since = Float()
+    start = Integer(load_default=0)
+    count = Integer()
+
 @app.get("/raw/_entries/<category>")
 @app.auth_required(auth)
-def _listentries(category):
-    return mycacher.listentries(category)
+@app.input(EntryListQuery, location='query')
+def _listentries(category, query_data=None):
+    return mycacher.listentries(category, **query_data)
+
+class EntryValuesQuery(Schema):
+    entry = List(String())
+
+@app.get("/raw/_entries/<category>/_values")
+@app.auth_required(auth)
+@app.input(EntryValuesQuery, location='query')
+def _getentries(category, query_data=None):
+    entries = query_data['entry'] if 'entry' in query_data else mycacher.listentries(category)
+    return mycacher.getentries(category, entries)
+
+class EntryBatchRequest(Schema):
+    entries = Dict(keys=String(), values=List(String()), required=True)
+
+@app.post("/raw/_values")
+@app.auth_required(auth)
+@app.input(EntryBatchRequest, location='json')
+def _getentriesbatch(json_data=None):
+    return mycacher.getentriesbatch(json_data['entries'])
+
+class HistoryQuery(Schema):
+    start = Float()
+    end = Float()
+    bucket = Float()
+    field = String(load_default='v')
+
+@app.get("/raw/_history/<category>/<entry>")
+@app.auth_required(auth)
+@app.input(HistoryQuery, location='query')
+def _gethistory(category, entry, query_data=None):
+    return mycacher.gethistory(category, entry, **query_data)
+
+def conditionalentry(category, entry):
+    # Answers If-None-Match / If-Modified-Since from the entry metadata alone and only
+    # reads the value when the client's copy is outdated. Unconditional requests read
+    # both at once.
+    conditional = bool(request.if_none_match) or request.if_modified_since is not None
+    if conditional:
+        meta = mycacher.getentrymeta(category, entry)
+    else:
+        value, meta = mycacher.getentrywithmeta(category, entry)
+    if meta is None:
+        raise HTTPError(404, 'No value cached')
+
+    etag = f"{meta['version']}-{meta['time']:.6f}"
+    lastmodified = datetime.fromtimestamp(int(meta['time']), timezone.utc)
+    if request.if_none_match:
+        notmodified = request.if_none_match.contains(etag)
+    else:
+        notmodified = request.if_modified_since is not None and lastmodified <= request.if_modified_since
+
+    if notmodified:
+        response = Response(status=304)
+    else:
+        if conditional:
+            value = mycacher.getentry(category, entry)
+        if value is None:
+            raise HTTPError(404, 'No value cached')
+        response = app.make_response(value)
+    response.set_etag(etag)
+    response.last_modified = lastmodified
+    return response
+
+def openstream(category, entry):
+    try:
+        return mybroadcaster.open(category, entry)
+    except TooManySubscribers:
+        raise HTTPError(503, 'Too many subscribers')
+
+def eventstream(category, entry=None, keepalive=15):
+    subscription = openstream(category, entry)
+
+    def generate():
+        try:
+            if entry is not None:
+                value = mycacher.getentry(category, entry)
+                if value is not None:
+                    yield f"event: update\ndata: {json.dumps({ 'category': category, 'entry': entry, 'value': value })}\n\n"
+            while True:
+                try:
+                    entryid, value = subscription.get(timeout=keepalive)
+                except Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: update\ndata: {json.dumps({ 'category': category, 'entry': entryid, 'value': value })}\n\n"
+        finally:
+            mybroadcaster.close(category, entry, subscription)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={ 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no' })
+    # The generator's finally never runs when it is not started (e.g. HEAD requests)
+    response.call_on_close(lambda: mybroadcaster.close(category, entry, subscription))
+    return response
+
+@app.get("/raw/_stream/<category>")
+@app.auth_required(auth)
+def _streamcategory(category):
+    return eventstream(category)
+
+@app.get("/raw/_stream/<category>/<entry>")
+@app.auth_required(auth)
+def _streamentry(category, entry):
+    return eventstream(category, entry)
+
+class PollQuery(Schema):
+    since = Float()
+    timeout = Float(load_default=25)
+
+@app.get("/raw/_poll/<category>/<entry>")
+@app.auth_required(auth)
+@app.input(PollQuery, location='query')
+def _pollentry(category, entry, query_data=None):
+    # Long-poll fallback: answers immediately when the entry changed after `since`,
+    # otherwise waits up to `timeout` seconds for the next update (204 if none).
+    subscription = openstream(category, entry)
+    try:
+        value = mycacher.getentry(category, entry)
+        since = query_data['since'] if 'since' in query_data else None
+        if value is not None and (since is None or datetime.fromisoformat(value['_meta']['time']).timestamp() > since):
+            return value
+        try:
+            _, value = subscription.get(timeout=min(query_data['timeout'], 60))
+        except Empty:
+            return '', 204
+        return value
+    finally:
+        mybroadcaster.close(category, entry, subscription)
 
 @app.get("/raw/_entry/<category>/<entry>")
 @app.auth_required(auth)
 def _getentry(category, entry):
-    value = mycacher.getentry(category, entry)
-    return value
+    return conditionalentry(category, entry)
+
+@app.get("/raw/_entry/<category>/<entry>/<field>")
+@app.auth_required(auth)
+def _getfield(category, entry, field):
+    value = mycacher.getfield(category, entry, field)
+    if value is None:
+        raise HTTPError(404, 'No value cached')
+    return { field: value }
+
+@app.get("/raw/_cachestats")
+@app.auth_required(auth)
+def _cachestats():
+    return dict(mycacher.stats(), streaming=mybroadcaster.stats())
+
+class CategoryReportQuery(Schema):
+    samples = Integer(load_default=10)
+
+@app.get("/raw/_categoryreport")
+@app.auth_required(auth)
+@app.input(CategoryReportQuery, location='query')
+def _categoryreport(query_data=None):
+    return mycacher.categoryreport(**query_data)
 
 @app.post("/cache/<key>/<value>")
 @app.auth_required(auth)
@@ -109,21 +311,27 @@ def writecache(key, value):
 
 fieldmodule = importlib.import_module('apiflask.fields')
 
-def dict2schemadict(map):
-    for key in map.keys():
-        app.logger.debug(f"Setting field type to {map[key]}")        
-        class_ = getattr(fieldmodule, map[key])
-        instance = class_()
-        map[key] = instance
+schemas = {}
+
+def argumentschema(arguments):
+    # arguments maps argument name -> apiflask field type name. Mappings with the same
+    # arguments share one schema class, built the first time it is needed.
+    signature = tuple(sorted(arguments.items()))
+    if signature not in schemas:
+        name = "".join(f"{argument.capitalize()}{fieldtype}" for argument, fieldtype in signature)
+        schemas[signature] = Schema.from_dict(
+            { argument: getattr(fieldmodule, fieldtype)() for argument, fieldtype in signature },
+            name=f"{name}Arguments")
+    return schemas[signature]
 
 def generategettermappings(queuemanager):
     queuecollection = queuemanager.getsettings()
-    app.logger.info(f"Found queues {queuecollection}")
+    app.logger.info(f"Found queues {list(queuecollection.keys())}")
 
     for queueid in queuecollection.keys():
         queuesettings = queuecollection[queueid]
         
-        app.logger.info(f"Registering mappings for {queueid} -> {queuesettings}")
+        app.logger.info(f"Registering mappings for {queueid}")
 
         mappings = queuesettings['mapping'] if 'mapping' in queuesettings else {}
 
@@ -141,26 +349,34 @@ def generategettermappings(queuemanager):
                     @app.auth_required(auth)
                     @auth.login_required(role='getter')
                     def getvalue():
-                        f"""
-                        {map['description']}
-                        """
-                        app.logger.debug(f"Returning mapped entry for {q} and {e}")
-                        app.logger.debug(f"User is {auth.current_user}")
-                        entry = mycacher.getentry(q, e)
-                        if entry:
-                            return entry
-                        else:
-                            raise HTTPError(404, 'No value cached')
+                        app.logger.debug("Returning mapped entry for %s and %s", q, e)
+                        return conditionalentry(q, e)
                     return getvalue
 
                 implementation = gengetvalue(queueid, map['from'])
                 implementation.__doc__ = map['description']
                 app.add_url_rule( base, map['description'], implementation )
 
+                if 'history' in queuesettings:
+                    def gengethistory(queueid, entry):
+                        q = queueid
+                        e = entry
+
+                        @app.auth_required(auth)
+                        @auth.login_required(role='getter')
+                        @app.input(HistoryQuery, location='query')
+                        def gethistory(query_data=None):
+                            return mycacher.gethistory(q, e, **query_data)
+                        return gethistory
+
+                    historyimplementation = gengethistory(queueid, map['from'])
+                    historyimplementation.__doc__ = f"{map['description']} (history)"
+                    app.add_url_rule( f"{base}/history", f"{map['description']} history", historyimplementation )
+
                 if 'post' in map and map['post']:
                     app.logger.debug(f"map is {map}")
                     handlefunction = queuemanager.getposthandler(queueid, map)
-                    app.logger.debug(f"Retrieved handlerfunction {handlefunction} that should be {queuemanager.getposthandler(queueid, map)}")
+                    app.logger.debug("Retrieved handlerfunction %s", handlefunction)
 
                     def genpostvalue(queueid, entry, thisschema):
                         q = queueid
@@ -172,73 +388,73 @@ def generategettermappings(queuemanager):
                         @auth.login_required(role='setter')
                         @app.input( thisschema, location='json')
                         def postvalue(json_data=None):
-                            app.logger.debug(f"Posting value [{json_data}] to {q} and {e} ")
+                            app.logger.debug("Posting value [%s] to %s and %s", json_data, q, e)
                             h(**json_data)
                             return "OK"
                         return postvalue
                     
-                    schemadict = map['handlermethod']['args']
-                    dict2schemadict(schemadict)
-
-                    app.logger.debug(f"schemadict is {schemadict}")
-                    postimplementation = genpostvalue(queueid, map['from'], schemadict )
+                    postimplementation = genpostvalue(queueid, map['from'], argumentschema(map['handlermethod']['args']))
                     postimplementation.__doc__ = map['description']
 
-                    schema = Schema.from_dict( {"json_data": Integer() })
-
-def setupusers(users):
-    app.logger.info(f"Doing users: {users}")
-    global userbase 
-    userbase = { userinfo['token']: userinfo['id'] for userinfo in users }
-
-    global rolebase
-    rolebase = { userinfo['id']: userinfo['roles'] for userinfo in users if 'roles' in userinfo }
-    app.logger.info(f"Userbase is now: {userbase}")
-
-def preheatcache(app, settings):
-    app.logger.info(f"preheat: settings is {settings}")
-    for queuetype in settings.keys():
-        app.logger.info(f"preheat: queuetype: {queuetype}")
-        if isinstance(settings[queuetype], Mapping):
-            for queueid in settings[queuetype].keys():
-                app.logger.info(f"preheat: queueid: {queueid}")
-                if isinstance(settings[queuetype][queueid], Mapping) and 'preheat' in settings[queuetype][queueid]:
-                    preheatcollection = settings[queuetype][queueid]['preheat'].keys()
-                    app.logger.info(f"preheat: doing {preheatcollection}")
-                    for pentry in preheatcollection:
-                        app.logger.debug(f"preheat: entry = {pentry}")
-                        entry = mycacher.getentry(categoryid=queueid, entryid=pentry)
-                        app.logger.debug(f"preheat: entry value = {entry}")
-                        if  entry is None:
-                            mycacher.updatecache(categoryid=queueid, entryid=pentry, entry=settings[queuetype][queueid]['preheat'][pentry])
-                        else:
-                            app.logger.info(f"preheat: {queueid}/{pentry} found, not preheating")
-
+def setupusers(users, reloadinterval=0):
+    global tokentable
+    tokentable = TokenTable(users, reloadinterval)
 
 def setup_app(app, settings):
+    timings = []
+    started = time.perf_counter()
+    def lap(step):
+        nonlocal started
+        now = time.perf_counter()
+        timings.append(f"{step} {(now - started) * 1000:.1f}ms")
+        started = now
+
     global mycacher
     mycacher = ValkeyCacher(settings['valkey'])
-    setupusers(settings['users'])
-    app.logger.info("Starting queue thread")
+    if 'localcache' in settings['valkey']:
+        mycacher = LocalCacher(mycacher, **settings['valkey']['localcache'])
+    global mybroadcaster
+    streaming = dict(settings['streaming']) if 'streaming' in settings else {}
+    threads = os.getenv("THREADS")
+    if threads is not None:
+        # Every subscriber holds a worker thread, keep one free for other requests when
+        # that still leaves room for a subscriber
+        maxsubscribers = streaming['maxsubscribers'] if 'maxsubscribers' in streaming else 100
+        if int(threads) < 2:
+            app.logger.warning(f"Streaming clients can occupy all {threads} threads, run with THREADS of at least 2")
+        elif maxsubscribers > int(threads) - 1:
+            streaming['maxsubscribers'] = int(threads) - 1
+            app.logger.warning(f"Limiting streaming to {streaming['maxsubscribers']} subscribers for {threads} threads")
+    mybroadcaster = Broadcaster(mycacher, **streaming)
+    lap("cacher")
+    setupusers(settings['users'], **(settings['auth'] if 'auth' in settings else {}))
+    lap("users")
     queue = Queue()
     app.queue = queue
-    rabbitlistener = RabbitListener(mycacher, queue=queue, settings=settings['rabbitqueues'])
+    rabbitlistener = createlistener(mycacher, queue, settings['rabbitqueues'])
     app.listeners = {'rabbitqueues': rabbitlistener }
     app.cache = rabbitlistener
-    app.cache.start()
-    app.logger.info("rabbitlistener queue thread started")
+    if ingest:
+        app.logger.info("Starting queue thread")
+        app.cache.start()
+        app.logger.info("rabbitlistener queue thread started")
+        mycacher.startsweeper()
+    else:
+        app.logger.info("Ingestion disabled, serving from cache only")
+    lap("listeners")
     app.logger.info("Generating getter mappings")
     generategettermappings(rabbitlistener)
     app.logger.info("Generated getter mappings")
-    app.logger.info("Preheating cache")
-    preheatcache(app, settings)
-    app.logger.info("Preheated cache")
+    lap("mappings")
+    if ingest:
+        app.logger.info("Preheating cache")
+        preheatcache(mycacher, settings)
+        app.logger.info("Preheated cache")
+        lap("preheat")
+    app.logger.info(f"Startup took {', '.join(timings)}")
     return app
 
-cacheconfig = os.getenv("CACHECONFIG")
-
-with open(cacheconfig,"r") as settingsfile:
-    settings = yaml.safe_load(settingsfile)
+settings = loadsettings()
 app.logger.debug(f"settings={settings}")
     
 setup_app(app, settings)
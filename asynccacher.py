@@ -0,0 +1,79 @@
+from logging import getLogger
+import valkey.asyncio
+from valkey.asyncio.retry import Retry
+
+from cacher import ValkeyLayout, poolsettings
+
+logger = getLogger(__name__)
+
+class AsyncValkeyCacher(ValkeyLayout):
+    # cacher.ValkeyCacher for asyncio code: the same keys, layouts, codecs and round
+    # trips, but every method is a coroutine. Index maintenance (rebuilding, sweeping),
+    # preheating and subscribing to update notifications are left to a synchronous ValkeyCacher.
+    def __init__(self, settings, delimiter=':'):
+        pool = valkey.asyncio.BlockingConnectionPool(**poolsettings(settings, Retry))
+        self.valkeyconnection = valkey.asyncio.Valkey(connection_pool=pool)
+        logger.info(f"Connecting to valkey {settings['host']}:{settings['port']} with at most {pool.max_connections} connections")
+        self.configure(settings, delimiter)
+
+    async def close(self):
+        await self.valkeyconnection.aclose()
+
+    async def run(self, steps):
+        # Awaits the round trips of a ValkeyLayout step generator
+        result = None
+        try:
+            while True:
+                name, call = steps.send(result)
+                with self.command(name):
+                    result = await call()
+        except StopIteration as stop:
+            return stop.value
+
+    def configurecategory(self, categoryid, settings):
+        self.categorysettings[categoryid] = settings
+
+    def connectionsettings(self):
+        return self.settings
+
+    async def updatecache(self, categoryid, entryid, entry):
+        return (await self.updatecachemany(categoryid, [ (entryid, entry) ]))[0][1]
+
+    async def updatecachemany(self, categoryid, entries):
+        return await self.run(self.writesteps(categoryid, entries))
+
+    async def evict(self, categoryid, count):
+        await self.run(self.evictsteps(categoryid, count))
+
+    async def getentry(self, categoryid, entryid):
+        return await self.run(self.entrysteps(categoryid, entryid))
+
+    async def getfield(self, categoryid, entryid, field):
+        return await self.run(self.fieldsteps(categoryid, entryid, field))
+
+    async def getentries(self, categoryid, entryids):
+        return (await self.getentriesbatch({ categoryid: entryids }))[categoryid]
+
+    async def getentriesbatch(self, query):
+        return await self.run(self.batchsteps(query))
+
+    async def getentrymeta(self, categoryid, entryid):
+        return await self.run(self.metasteps(categoryid, entryid))
+
+    async def getentrywithmeta(self, categoryid, entryid):
+        return await self.run(self.entrymetasteps(categoryid, entryid))
+
+    async def gethistory(self, categoryid, entryid, start=None, end=None, bucket=None, field='v'):
+        return await self.run(self.historysteps(categoryid, entryid, start, end, bucket, field))
+
+    async def publishstatus(self, name, status, ttl):
+        await self.run(self.publishstatussteps(name, status, ttl))
+
+    async def getstatus(self, name):
+        return await self.run(self.statussteps(name))
+
+    async def listcategories(self):
+        return await self.run(self.categoriessteps())
+
+    async def listentries(self, categoryid, since=None, start=0, count=None):
+        return await self.run(self.entriessteps(categoryid, since, start, count))
@@ -0,0 +1,197 @@
+import asyncio
+import threading
+import secrets
+import time
+from types import SimpleNamespace
+from logging import getLogger
+import aio_pika
+
+from rabbitlistener import RabbitListener, Acknowledger, Backoff, WorkerPool, prefetchcount, gethandlerclass
+from asynccacher import AsyncValkeyCacher
+import metrics
+
+logger = getLogger(__name__)
+
+class AsyncChannelAdapter(object):
+    # Gives Handler.handlemessage the acknowledgement calls of a pika channel.
+    # Handlers run on the event loop thread, so the calls are scheduled as tasks.
+    def __init__(self, loop, channel):
+        self.loop = loop
+        self.channel = channel
+
+    async def _basic_ack(self, delivery_tag, multiple):
+        underlay = await self.channel.get_underlay_channel()
+        await underlay.basic_ack(delivery_tag, multiple=multiple)
+
+    async def _basic_nack(self, delivery_tag, multiple, requeue):
+        underlay = await self.channel.get_underlay_channel()
+        await underlay.basic_nack(delivery_tag, multiple=multiple, requeue=requeue)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.loop.create_task(self._basic_ack(delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.loop.create_task(self._basic_nack(delivery_tag, multiple, requeue))
+
+
+class AsyncRabbitListener(RabbitListener):
+    # Consumes all configured queues from a single event loop. Queues on the same
+    # broker share one connection and each get their own channel.
+    def __init__(self, cachemanager, **kwargs):
+        super().__init__(cachemanager, **kwargs)
+        self.loop = None
+        self.connections = {}
+        self.asynccacher = None
+
+    def start(self):
+        logger.debug(f"Starting event loop with {self._settings}")
+        self.loop = asyncio.new_event_loop()
+        for queueid in self._settings.keys():
+            self.consumerstate(queueid)
+        listener_thread = threading.Thread(target=self.run, name="asynclistener", daemon=True)
+        listener_thread.start()
+        self.threads['asynclistener'] = listener_thread
+        logger.info("Event loop thread started")
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.consumeall())
+        self.loop.run_forever()
+
+    async def connect(self, settings):
+        key = (settings['MQRABBIT_HOST'], settings['MQRABBIT_PORT'], settings['MQRABBIT_VHOST'], settings['MQRABBIT_USER'])
+        if key not in self.connections:
+            logger.info(f"Connecting to {settings['MQRABBIT_HOST']}:{settings['MQRABBIT_PORT']}{settings['MQRABBIT_VHOST']}")
+            self.connections[key] = await aio_pika.connect_robust(
+                host=settings['MQRABBIT_HOST'],
+                port=settings['MQRABBIT_PORT'],
+                virtualhost=settings['MQRABBIT_VHOST'],
+                login=settings['MQRABBIT_USER'],
+                password=settings['MQRABBIT_PASSWORD'])
+        return self.connections[key]
+
+    async def consumeall(self):
+        self.asynccacher = self.createasynccacher()
+        for queueid in self._settings.keys():
+            self.loop.create_task(self.supervise(self._settings[queueid], queueid))
+
+    def createasynccacher(self):
+        # Handlers that support it write through a cacher of their own on the event
+        # loop instead of blocking it with the synchronous one
+        connectionsettings = self.cachemanager.connectionsettings()
+        if connectionsettings is None:
+            return None
+        asynccacher = AsyncValkeyCacher(connectionsettings)
+        for queueid in self._settings.keys():
+            asynccacher.configurecategory(queueid, self._settings[queueid])
+        return asynccacher
+
+    def createasynchandler(self, id, settings, logger):
+        # Coalescing is done by the synchronous CoalescingCacher
+        handlerclass = gethandlerclass(settings)
+        if self.asynccacher is None or 'coalesce' in settings or not handlerclass.asynchronous:
+            return None
+        logger.debug(f"Handling {id} on the event loop with {handlerclass}")
+        return handlerclass(id, logger, self.asynccacher, settings)
+
+    async def supervise(self, settings, id):
+        # Robust connections restore consumers by themselves once they are set up, this
+        # retries setting them up with a jittered exponential backoff.
+        logger = getLogger(f"rabbitlistener.{id}")
+        state = self.consumerstate(id)
+        backoff = Backoff.fromsettings(settings)
+        handler = self.createhandler(id, settings, logger)
+        pool = WorkerPool.fromsettings(id, handler, settings, self.cachemanager, logger)
+        asynchandler = self.createasynchandler(id, settings, logger) if pool is None else None
+        while True:
+            try:
+                state.setstate('connecting')
+                await self.consume(settings, id, handler, pool, asynchandler, state, logger)
+                backoff.reset()
+                return
+            except Exception as exc:
+                delay = backoff.next()
+                logger.warning(f"Unable to start consuming {id} ({exc}), retrying in {delay:.1f}s")
+                state.setstate('reconnecting', exc)
+                await asyncio.sleep(delay)
+
+    async def consume(self, settings, id, handler, pool, asynchandler, state, logger):
+        connection = await self.connect(settings)
+        connection.close_callbacks.add(lambda sender, exc=None: state.setstate('reconnecting', exc))
+        connection.reconnect_callbacks.add(lambda sender: state.setstate('consuming'))
+        channel = await connection.channel()
+        await channel.set_qos(prefetch_count=prefetchcount(settings, logger))
+
+        queuename = f"rabbitlistener-{id}-{secrets.token_hex(10)}"
+        queue = await channel.declare_queue(queuename, exclusive=True, auto_delete=True)
+
+        routing_key = settings['MQRABBIT_ROUTINGKEY'] if 'MQRABBIT_ROUTINGKEY' in settings else ""
+        exchange = settings['MQRABBIT_EXCHANGE'] if 'MQRABBIT_EXCHANGE' in settings else ""
+
+        logger.info(f"Binding queue to exchange: [{exchange}]")
+        await queue.bind(exchange, routing_key=routing_key)
+
+        adapter = AsyncChannelAdapter(self.loop, channel)
+        acknowledger = Acknowledger.fromsettings(adapter, self.loop.call_later, settings, logger)
+        # The robust channel is reopened with new delivery tags, already before
+        # reconnect_callbacks run, so start over as soon as the old one is closed
+        channel.close_callbacks.add(lambda sender, exc=None: acknowledger.reset())
+        connection.close_callbacks.add(lambda sender, exc=None: acknowledger.reset())
+        if asynchandler is not None:
+            dispatch = self.asyncdispatcher(id, asynchandler, acknowledger, logger)
+        else:
+            dispatch = self.dispatcher(id, handler, acknowledger, logger, pool, self.loop.call_soon_threadsafe)
+
+        async def onmessage(message):
+            method = SimpleNamespace(
+                delivery_tag=message.delivery_tag,
+                redelivered=message.redelivered,
+                exchange=message.exchange,
+                routing_key=message.routing_key)
+            properties = SimpleNamespace(
+                content_type=message.content_type,
+                headers=message.headers)
+            dispatch(adapter, method, properties, message.body)
+
+        await queue.consume(onmessage)
+        state.setstate('consuming')
+        self.loop.create_task(self.checklag(settings, queue, state, logger))
+        logger.info("Waiting for messages")
+
+    def asyncdispatcher(self, id, handler, acknowledger, logger):
+        # Every delivery runs in a task of its own, so they are queued for a single
+        # worker to keep the messages of a queue in order while the handler awaits
+        consumed = metrics.messagesconsumed.labels(id)
+        state = self.consumerstate(id)
+        complete = self.completer(id, acknowledger, logger)
+        pending = asyncio.Queue()
+
+        async def work():
+            while True:
+                ch, method, properties, body, generation = await pending.get()
+                started = time.perf_counter()
+                try:
+                    await handler.handlemessageasync(ch, method, properties, body)
+                except Exception as exc:
+                    complete(method, exc, time.perf_counter() - started, generation)
+                    continue
+                complete(method, None, time.perf_counter() - started, generation)
+
+        self.loop.create_task(work())
+
+        def dispatch(ch, method, properties, body):
+            consumed.inc()
+            state.onmessage()
+            pending.put_nowait((ch, method, properties, body, acknowledger.generation))
+        return dispatch
+
+    async def checklag(self, settings, queue, state, logger):
+        laginterval = settings['MQRABBIT_LAGINTERVAL'] if 'MQRABBIT_LAGINTERVAL' in settings else 15
+        while True:
+            try:
+                # Messages waiting in the queue, not counting the prefetched ones
+                declared = await queue.declare()
+                state.setlag(declared.message_count)
+            except Exception as exc:
+                logger.debug(f"Unable to check queue lag: {exc}")
+            await asyncio.sleep(laginterval)
@@ -0,0 +1,56 @@
+# In-process stand-ins for Valkey and RabbitMQ so the benchmarks run without servers.
+
+import valkey
+import fakeredis
+
+import cacher
+
+class StubChannel(object):
+    # Records what the consumer acknowledges instead of talking to a broker
+    def __init__(self):
+        self.acked = 0
+        self.nacked = 0
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.acked += 1
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.nacked += 1
+
+    def call_later(self, delay, callback):
+        pass
+
+class StubMethod(object):
+    def __init__(self, delivery_tag, redelivered=False):
+        self.delivery_tag = delivery_tag
+        self.redelivered = redelivered
+        self.exchange = ''
+        self.routing_key = ''
+
+class ValkeyModule(object):
+    # Replaces the valkey module as seen by cacher, so every ValkeyCacher connects to
+    # the given factory's connection while pools, exceptions etc. stay the real ones.
+    def __init__(self, factory):
+        self.factory = factory
+
+    def Valkey(self, *args, **kwargs):
+        return self.factory()
+
+    def __getattr__(self, name):
+        return getattr(valkey, name)
+
+def usevalkey(address=None):
+    # address "host:port" uses a real (e.g. containerised) Valkey, None an in-process fake
+    if address:
+        host, port = address.split(':')
+        factory = lambda: valkey.Valkey(host=host, port=int(port))
+    else:
+        server = fakeredis.FakeServer()
+        factory = lambda: fakeredis.FakeValkey(server=server)
+    cacher.valkey = ValkeyModule(factory)
+    connection = factory()
+    connection.flushdb()
+    return connection
+
+def valkeysettings(prefix='bench'):
+    return { 'host': 'localhost', 'port': 6379, 'user': None, 'token': None, 'prefix': prefix }
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# Measures the per-message logging overhead of the RFC8428 handler with the logging
+# it did before (eager f-strings, body at INFO) and with the current lazy logging.
+#
+#   python benchmarks/logging_overhead.py [messages]
+
+import os
+import sys
+import json
+import time
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rabbitlistener import RFC8428, senmlrecords
+
+class NullCacher(object):
+    def updatecachemany(self, categoryid, entries):
+        return []
+
+class EagerRFC8428(RFC8428):
+    def handlemessage(self, ch, method, properties, body):
+        self.logger.info(f"RFC 8428 handler received {body}")
+        self.logger.debug(f" [{self.id}] Parsing")
+        senml = json.loads(body)
+        self.logger.debug(f" [{self.id}] Parsed")
+        self.logger.debug(f"senml = {senml}")
+        records = senmlrecords(senml)
+        for entryid, message in records:
+            self.logger.debug(f" [{self.id}] Storing at {entryid}: {message}")
+        self.cachemanager.updatecachemany(self.id, records)
+        self.logger.info(f" [{self.id}] Done")
+
+def makebody(records):
+    pack = [ { 'bn': 'urn:dev:ow:10e2073a01080063:', 'n': 'temp0', 'u': 'Cel', 'v': 23.1 } ]
+    pack += [ { 'n': f"temp{index}", 'u': 'Cel', 'v': 23.1 + index } for index in range(1, records) ]
+    return json.dumps(pack).encode('utf-8')
+
+def measure(handlerclass, level, body, messages):
+    logging.root.setLevel(level)
+    handler = handlerclass("bench", logging.getLogger("rabbitlistener.bench"), NullCacher(), {})
+    start = time.perf_counter()
+    for _ in range(messages):
+        handler.handlemessage(None, None, None, body)
+    return (time.perf_counter() - start) / messages * 1e6
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    devnull = open(os.devnull, 'w')
+    logging.basicConfig(stream=devnull, format='%(name)s:%(asctime)s:%(module)s:%(lineno)d:%(levelname)s: %(message)s')
+    logging.getLogger("payload").setLevel(logging.WARNING)
+
+    results = []
+    for records in (1, 10, 50):
+        body = makebody(records)
+        for level in (logging.INFO, logging.DEBUG):
+            before = measure(EagerRFC8428, level, body, messages)
+            after = measure(RFC8428, level, body, messages)
+            results.append({
+                'records': records,
+                'level': logging.getLevelName(level),
+                'before_us': round(before, 2),
+                'after_us': round(after, 2),
+            })
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# Benchmarks the ingest path, the listing endpoints' backing calls and the HTTP getters
+# against in-process fakes (or a local Valkey with --valkey host:port) and prints the
+# results as JSON, so runs on different commits can be compared.
+#
+#   pip install -r requirements.txt -r benchmarks/requirements.txt
+#   python benchmarks/run.py --output before.json
+#   python benchmarks/run.py --valkey localhost:6379
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import subprocess
+import tempfile
+
+import yaml
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import StubChannel, StubMethod, usevalkey, valkeysettings
+from cacher import ValkeyCacher
+from rabbitlistener import RabbitListener, Acknowledger
+
+def timed(function, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    total = sum(samples)
+    return {
+        'iterations': iterations,
+        'ops_per_sec': round(iterations / total, 1),
+        'mean_us': round(total / iterations * 1e6, 2),
+        'p50_us': round(samples[len(samples) // 2] * 1e6, 2),
+        'p95_us': round(samples[int(len(samples) * 0.95)] * 1e6, 2),
+    }
+
+def senmlpack(records, offset=0):
+    pack = [ { 'bn': 'urn:dev:bench:', 'n': f"sensor{offset}", 'u': 'Cel', 'v': 20.0 } ]
+    pack += [ { 'n': f"sensor{offset + index}", 'u': 'Cel', 'v': 20.0 + index } for index in range(1, records) ]
+    return json.dumps(pack).encode('utf-8')
+
+def benchingest(iterations):
+    results = []
+    for records in (1, 10, 50):
+        cacher = ValkeyCacher(valkeysettings())
+        queuesettings = { 'handler': 'RFC8428' }
+        listener = RabbitListener(cacher, queue=None, settings={ 'bench': queuesettings })
+        channel = StubChannel()
+        handler = listener.createhandler('bench', queuesettings, logging.getLogger('bench'))
+        dispatch = listener.dispatcher('bench', handler, Acknowledger(channel, channel.call_later), logging.getLogger('bench'))
+        body = senmlpack(records)
+        tags = iter(range(1, iterations + 1))
+        result = timed(lambda: dispatch(channel, StubMethod(next(tags)), None, body), iterations)
+        result['records_per_message'] = records
+        result['records_per_sec'] = round(result['ops_per_sec'] * records, 1)
+        results.append(result)
+    return results
+
+def benchlisting(connection, iterations):
+    results = []
+    for keyspace in (1000, 10000, 50000):
+        connection.flushdb()
+        cacher = ValkeyCacher(valkeysettings())
+        # One small category next to a keyspace of unrelated entries
+        for category in range(keyspace // 1000):
+            cacher.updatecachemany(f"filler{category}", [ (f"entry{index}", { 'v': index }) for index in range(1000) ])
+        cacher.updatecachemany('small', [ (f"entry{index}", { 'v': index }) for index in range(20) ])
+        results.append(dict(timed(cacher.listcategories, iterations), call='listcategories', keyspace=keyspace))
+        results.append(dict(timed(lambda: cacher.listentries('small'), iterations), call='listentries', keyspace=keyspace))
+    return results
+
+def benchhttp(iterations, workdir):
+    settings = {
+        'valkey': dict(valkeysettings(), localcache={ 'size': 1024, 'ttl': 30 }),
+        'users': [ { 'id': 'bench', 'token': 'benchtoken', 'roles': [ 'getter' ] } ],
+        'rabbitqueues': {
+            'bench': {
+                'handler': 'RFC8428',
+                'mapping': {
+                    'base': '/bench',
+                    'map': [ { 'from': 'urn:dev:bench:sensor0', 'to': 'sensor0', 'description': 'Bench sensor' } ]
+                }
+            }
+        }
+    }
+    configfile = os.path.join(workdir, 'config.yaml')
+    logfile = os.path.join(workdir, 'logging.yaml')
+    with open(configfile, 'w') as output:
+        yaml.safe_dump(settings, output)
+    with open(logfile, 'w') as output:
+        yaml.safe_dump({ 'version': 1, 'root': { 'level': 'WARNING', 'handlers': [] } }, output)
+    os.environ.update({ 'CACHECONFIG': configfile, 'LOGCONFIG': logfile, 'INGEST': '0' })
+
+    import app
+    app.mycacher.updatecachemany('bench', [ ('urn:dev:bench:sensor0', { 'v': 20.0 }) ])
+    client = app.app.test_client()
+    headers = { 'Authorization': 'Bearer benchtoken' }
+
+    results = []
+    for path, extra in (
+            ('/bench/sensor0', {}),
+            ('/raw/_entry/bench/urn:dev:bench:sensor0', {}),
+            ('/raw/_entries/bench', {})):
+        results.append(dict(timed(lambda: client.get(path, headers=dict(headers, **extra)), iterations), route=path))
+
+    etag = client.get('/bench/sensor0', headers=headers).headers['ETag']
+    results.append(dict(timed(lambda: client.get('/bench/sensor0', headers=dict(headers, **{ 'If-None-Match': etag })), iterations),
+                        route='/bench/sensor0', conditional=True))
+    return results
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repository, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--valkey', help="host:port of a Valkey to use instead of the in-process fake")
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--output', help="write the JSON results to this file")
+    parser.add_argument('--only', choices=[ 'ingest', 'listing', 'http' ], action='append')
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    connection = usevalkey(arguments.valkey)
+    only = arguments.only or [ 'ingest', 'listing', 'http' ]
+
+    results = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'valkey': arguments.valkey or 'fakeredis',
+    }
+    if 'ingest' in only:
+        results['ingest'] = benchingest(arguments.iterations)
+    if 'listing' in only:
+        results['listing'] = benchlisting(connection, arguments.iterations)
+    if 'http' in only:
+        with tempfile.TemporaryDirectory() as workdir:
+            results['http'] = benchhttp(arguments.iterations, workdir)
+
+    output = json.dumps(results, indent=2)
+    if arguments.output:
+        with open(arguments.output, 'w') as outputfile:
+            outputfile.write(output)
+    print(output)
+
+if __name__ == "__main__":
+    main()
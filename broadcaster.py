@@ -0,0 +1,75 @@
+import threading
+from queue import Queue, Full, Empty
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+class TooManySubscribers(Exception):
+    pass
+
+class Broadcaster(object):
+    # Pushes cache updates to streaming clients. Updates arrive through the cacher's
+    # update subscription, so writes from any process are seen. Each client gets a
+    # bounded queue; a client that falls behind loses its oldest pending updates
+    # rather than holding up the others.
+    def __init__(self, cacher, maxsubscribers=100, queuesize=16):
+        self.cacher = cacher
+        self.maxsubscribers = maxsubscribers
+        self.queuesize = queuesize
+        self.subscriptions = {}
+        self.count = 0
+        self.lock = threading.Lock()
+        cacher.subscribe(self.onupdate)
+        logger.info(f"Broadcasting updates to at most {maxsubscribers} subscribers")
+
+    def open(self, categoryid, entryid=None):
+        # entryid None subscribes to every entry of the category
+        with self.lock:
+            if self.count >= self.maxsubscribers:
+                raise TooManySubscribers(f"{self.count} subscribers connected")
+            subscription = Queue(self.queuesize)
+            self.subscriptions.setdefault((categoryid, entryid), set()).add(subscription)
+            self.count += 1
+            return subscription
+
+    def close(self, categoryid, entryid, subscription):
+        with self.lock:
+            subscribers = self.subscriptions.get((categoryid, entryid))
+            if subscribers is not None and subscription in subscribers:
+                subscribers.discard(subscription)
+                self.count -= 1
+                if not subscribers:
+                    del self.subscriptions[(categoryid, entryid)]
+
+    def onupdate(self, categoryid, entryids, local):
+        if categoryid is None:
+            return
+
+        with self.lock:
+            interested = {}
+            for entryid in entryids:
+                subscribers = self.subscriptions.get((categoryid, entryid), set()) | self.subscriptions.get((categoryid, None), set())
+                if subscribers:
+                    interested[entryid] = subscribers
+        if not interested:
+            return
+
+        values = self.cacher.getentries(categoryid, list(interested.keys()))
+        for entryid, subscribers in interested.items():
+            for subscription in subscribers:
+                self.deliver(subscription, (entryid, values[entryid]))
+
+    def deliver(self, subscription, update):
+        while True:
+            try:
+                subscription.put_nowait(update)
+                return
+            except Full:
+                try:
+                    subscription.get_nowait()
+                except Empty:
+                    pass
+
+    def stats(self):
+        with self.lock:
+            return { 'subscribers': self.count, 'maxsubscribers': self.maxsubscribers }
@@ -1,15 +1,29 @@
 from logging import getLogger
 from datetime import datetime
+from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
+import threading
+import secrets
+import time
 import valkey
+from valkey.retry import Retry
+from valkey.backoff import ExponentialBackoff
 import json
 
+import metrics
+
 from abc import ABC, abstractmethod
 
 logger = getLogger(__name__)
 
+class CacheBackendError(Exception):
+    # The cache could not be reached; unlike a missing entry this is not the caller's fault
+    pass
+
 class Cacher(ABC):
     @abstractmethod
-    def listentries(self, categoryid):
+    def listentries(self, categoryid, since=None, start=0, count=None):
         pass
 
     @abstractmethod
@@ -20,78 +34,1071 @@ class Cacher(ABC):
     def updatecache(self, categoryid, entryid, entry):
         pass
 
+    @abstractmethod
+    def updatecachemany(self, categoryid, entries):
+        pass
+
     @abstractmethod
     def getentry(categoryid, entryid):
         pass
 
+    @abstractmethod
+    def getentries(self, categoryid, entryids):
+        pass
+
 class BaseCacher(Cacher):
-    pass
+    def updatecachemany(self, categoryid, entries):
+        return [ (entryid, self.updatecache(categoryid, entryid, entry)) for entryid, entry in entries ]
 
-class ValkeyCacher(BaseCacher):
-    def __init__(self, settings, delimiter=':'):
-        self.valkeyconnection = valkey.Valkey(
-            host=settings['host'],
-            port=settings['port'],
-            db = 0,
-            username=settings['user'],
-            password=settings['token']
-        )
-        logger.info(f"Connected to valkey {settings['host']}:{settings['port']}")
+    def getentries(self, categoryid, entryids):
+        return { entryid: self.getentry(categoryid, entryid) for entryid in entryids }
+
+    def getfield(self, categoryid, entryid, field):
+        entry = self.getentry(categoryid, entryid)
+        return entry[field] if entry and field in entry else None
+
+    def getentriesbatch(self, query):
+        # query maps categoryid -> list of entryids
+        return { categoryid: self.getentries(categoryid, entryids) for categoryid, entryids in query.items() }
+
+    def configurecategory(self, categoryid, settings):
+        pass
+
+    def startsweeper(self):
+        pass
+
+    def preheat(self, query):
+        # query maps categoryid -> {entryid: entry}; only entries not cached yet are
+        # written. Returns the (categoryid, entryid) pairs that were written.
+        written = []
+        for categoryid, entries in query.items():
+            for entryid, entry in entries.items():
+                if self.getentry(categoryid, entryid) is None:
+                    self.updatecache(categoryid, entryid, entry)
+                    written.append((categoryid, entryid))
+        return written
+
+    def getentrymeta(self, categoryid, entryid):
+        # Cheap change detection: {'version': <write counter>, 'time': <epoch of last write>}
+        return None
+
+    def getentrywithmeta(self, categoryid, entryid):
+        # (entry, meta) for reads that need both
+        return self.getentry(categoryid, entryid), self.getentrymeta(categoryid, entryid)
+
+    def gethistory(self, categoryid, entryid, start=None, end=None, bucket=None, field='v'):
+        return []
+
+    def subscribe(self, callback):
+        pass
+
+    def stats(self):
+        return {}
+
+    def categoryreport(self, samples=10):
+        return {}
+
+    def publishstatus(self, name, status, ttl):
+        pass
+
+    def getstatus(self, name):
+        return None
+
+    def connectionsettings(self):
+        # Settings another process can use to build an equivalent ValkeyCacher
+        return None
+
+def downsample(points, bucket, field):
+    # Aggregates numeric values of field into min/max/avg per bucket of `bucket` seconds
+    buckets = OrderedDict()
+    for point in points:
+        value = point[field] if field in point else None
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        bucketstart = point['_time'] // bucket * bucket
+        if bucketstart not in buckets:
+            buckets[bucketstart] = { '_time': bucketstart, 'min': value, 'max': value, 'sum': value, 'count': 1 }
+        else:
+            aggregate = buckets[bucketstart]
+            aggregate['min'] = min(aggregate['min'], value)
+            aggregate['max'] = max(aggregate['max'], value)
+            aggregate['sum'] += value
+            aggregate['count'] += 1
+    for aggregate in buckets.values():
+        aggregate['avg'] = aggregate.pop('sum') / aggregate['count']
+    return list(buckets.values())
+
+class JsonCodec(object):
+    def encode(self, value):
+        return json.dumps(value)
+
+    def decode(self, data):
+        return json.loads(data)
+
+class OrjsonCodec(object):
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    def encode(self, value):
+        return self.orjson.dumps(value)
+
+    def decode(self, data):
+        return self.orjson.loads(data)
+
+class MsgpackCodec(object):
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def encode(self, value):
+        return self.msgpack.packb(value)
+
+    def decode(self, data):
+        return self.msgpack.unpackb(data)
+
+codecclasses = { 'json': JsonCodec, 'orjson': OrjsonCodec, 'msgpack': MsgpackCodec }
+codecs = {}
+
+def getcodec(name):
+    if name not in codecs:
+        codecs[name] = codecclasses[name]()
+    return codecs[name]
+
+def poolsettings(settings, retryclass=Retry):
+    # Connection pool options from the optional 'pool' section of the valkey settings
+    pool = settings['pool'] if 'pool' in settings else {}
+    def option(name, default):
+        return pool[name] if name in pool else default
+    return {
+        'host': settings['host'],
+        'port': settings['port'],
+        'db': 0,
+        'username': settings['user'],
+        'password': settings['token'],
+        'max_connections': option('maxconnections', 50),
+        # Seconds to wait for a free connection when all are in use
+        'timeout': option('timeout', 5),
+        'socket_timeout': option('sockettimeout', 5),
+        'socket_connect_timeout': option('connecttimeout', 2),
+        'socket_keepalive': True,
+        'health_check_interval': option('healthcheckinterval', 30),
+        'retry': retryclass(ExponentialBackoff(cap=option('retrybackoffmax', 1), base=option('retrybackoff', 0.05)), option('retries', 3)),
+        'retry_on_error': [ valkey.exceptions.ConnectionError, valkey.exceptions.TimeoutError ],
+    }
+
+class ValkeyLayout(object):
+    # Key layout, codecs and pipeline building shared by ValkeyCacher and
+    # asynccacher.AsyncValkeyCacher, which only differ in how they talk to Valkey
+    def configure(self, settings, delimiter):
+        self.settings = settings
         self.valkeyprefix = settings['prefix']
         self.delimiter = delimiter
+        # Values are written with the configured codec, either as one string per entry or
+        # as a hash with one field per entry field. Both layouts and all codecs are
+        # readable regardless of the current configuration.
+        self.codecname = settings['codec'] if 'codec' in settings else 'json'
+        self.codec = getcodec(self.codecname)
+        self.hashstorage = ('storage' in settings and settings['storage'] == 'hash')
+        logger.info(f"Storing values using {self.codecname} as {'hashes' if self.hashstorage else 'strings'}")
+        self.origin = secrets.token_hex(8)
+        self.categorysettings = {}
 
-    def updatecache(self, categoryid, entryid, entry):
-        cachevalue = {
-            'entry': entry,
-            'meta': {
-                'time': datetime.now().isoformat()
-            }
+    @contextmanager
+    def command(self, name):
+        # Times a Valkey round trip and reports an unreachable Valkey as CacheBackendError
+        try:
+            with metrics.valkeylatency.labels(name).time():
+                yield
+        except (valkey.exceptions.ConnectionError, valkey.exceptions.TimeoutError) as exc:
+            raise CacheBackendError(f"Valkey {name} failed: {exc}") from exc
+
+    def entrykey(self, categoryid, entryid):
+        return f"{self.valkeyprefix}{self.delimiter}{categoryid}{self.delimiter}{entryid}"
+
+    def updatechannel(self):
+        return f"{self.valkeyprefix}{self.delimiter}_updates"
+
+    def versionkey(self, categoryid):
+        return f"{self.valkeyprefix}{self.delimiter}_index{self.delimiter}versions{self.delimiter}{categoryid}"
+
+    def historykey(self, categoryid, entryid):
+        return f"{self.valkeyprefix}{self.delimiter}_history{self.delimiter}{categoryid}{self.delimiter}{entryid}"
+
+    def categoryindexkey(self):
+        return f"{self.valkeyprefix}{self.delimiter}_index{self.delimiter}categories"
+
+    def entryindexkey(self, categoryid):
+        return f"{self.valkeyprefix}{self.delimiter}_index{self.delimiter}entries{self.delimiter}{categoryid}"
+
+    def statuskey(self, name):
+        return f"{self.valkeyprefix}{self.delimiter}_status{self.delimiter}{name}"
+
+    def categorysetting(self, categoryid, name):
+        settings = self.categorysettings[categoryid] if categoryid in self.categorysettings else {}
+        return settings[name] if name in settings else None
+
+    def historysettings(self, categoryid):
+        return self.categorysetting(categoryid, 'history')
+
+    def queuehistory(self, pipeline, categoryid, entryid, entry, now, history):
+        # One sorted set per entry scored by write time, capped by age and length
+        retention = history['retention'] if 'retention' in history else 86400
+        maxlen = history['maxlen'] if 'maxlen' in history else 10000
+        historykey = self.historykey(categoryid, entryid)
+        pipeline.zadd(historykey, { json.dumps([now, entry]): now })
+        pipeline.zremrangebyscore(historykey, '-inf', now - retention)
+        pipeline.zremrangebyrank(historykey, 0, -(maxlen + 1))
+        pipeline.expire(historykey, int(retention))
+
+    def splitmeta(self, entry, now):
+        meta = {
+            'time': datetime.fromtimestamp(now).isoformat()
         }
-        valkeykey = f"{self.valkeyprefix}{self.delimiter}{categoryid}{self.delimiter}{entryid}"
-        valkeyval = json.dumps(cachevalue)
-        logger.debug(f"updating valkey {valkeykey} with {valkeyval}")
-        self.valkeyconnection.set(valkeykey, valkeyval)
-        logger.debug(f"updated valkey {valkeykey} with {valkeyval}")
+        if '_meta' in entry:
+            # Writers may add their own metadata next to the write time
+            entry = dict(entry)
+            meta.update(entry.pop('_meta'))
+        return entry, meta
 
-    def getentry(self, categoryid, entryid):
-        valkeykey = f"{self.valkeyprefix}{self.delimiter}{categoryid}{self.delimiter}{entryid}"
-        try:
-            value = json.loads(self.valkeyconnection.get(valkeykey))
-            logger.debug(f"Value found: {value}")
-            rvalue = value['entry']
-            rvalue['_meta'] = value['meta']
-            return rvalue
-        except:
-            logger.debug("Value not found")
+    def queueindex(self, pipeline, categoryid, entryid, now):
+        pipeline.zadd(self.entryindexkey(categoryid), {entryid: now})
+        pipeline.hincrby(self.versionkey(categoryid), entryid, 1)
+
+    def queueupdate(self, pipeline, categoryid, entryid, entry, now, ttl=None):
+        entry, meta = self.splitmeta(entry, now)
+        valkeykey = self.entrykey(categoryid, entryid)
+        logger.debug("updating valkey %s with %s", valkeykey, entry)
+        if self.hashstorage:
+            fields = { field: self.codec.encode(value) for field, value in entry.items() }
+            fields['_meta'] = self.codec.encode(meta)
+            fields['_codec'] = self.codecname
+            pipeline.delete(valkeykey)
+            pipeline.hset(valkeykey, mapping=fields)
+            if ttl:
+                pipeline.expire(valkeykey, ttl)
+        else:
+            pipeline.set(valkeykey, self.codec.encode({ 'entry': entry, 'meta': meta }), ex=ttl)
+        self.queueindex(pipeline, categoryid, entryid, now)
+        history = self.historysettings(categoryid)
+        if history is not None:
+            self.queuehistory(pipeline, categoryid, entryid, entry, now, history)
+        return dict(entry, _meta=meta)
+
+    def queuepublish(self, pipeline, categoryid, entryids, origin=True):
+        pipeline.publish(self.updatechannel(), json.dumps({
+            'origin': self.origin if origin else None,
+            'category': categoryid,
+            'entries': entryids
+        }))
+
+    def queueremove(self, pipeline, categoryid, entryids):
+        pipeline.delete(*[ self.entrykey(categoryid, entryid) for entryid in entryids ])
+        pipeline.delete(*[ self.historykey(categoryid, entryid) for entryid in entryids ])
+        pipeline.zrem(self.entryindexkey(categoryid), *entryids)
+        pipeline.hdel(self.versionkey(categoryid), *entryids)
+        # Without an origin the removal also reaches this process' own local cache, which
+        # otherwise ignores its own (write-through) updates
+        self.queuepublish(pipeline, categoryid, entryids, origin=False)
+
+    def decodeentry(self, valkeyval):
+        if valkeyval is None:
             return None
-        
-    def listcategories(self):
+
+        if isinstance(valkeyval, dict):
+            # Hash layout, every field encoded with the codec named in _codec
+            if not valkeyval:
+                return None
+            codec = getcodec(valkeyval.pop(b'_codec').decode('utf-8'))
+            return { field.decode('utf-8'): codec.decode(value) for field, value in valkeyval.items() }
+
+        # String layout. JSON documents start with '{', msgpack maps never do.
+        if valkeyval[:1] == b'{':
+            value = getcodec('orjson' if self.codecname == 'orjson' else 'json').decode(valkeyval)
+        else:
+            value = getcodec('msgpack').decode(valkeyval)
+        rvalue = value['entry']
+        rvalue['_meta'] = value['meta']
+        return rvalue
+
+    # Reads and writes are written once, as generators that yield (name, call) for every
+    # round trip and are sent its result. ValkeyCacher.run calls call(), AsyncValkeyCacher.run
+    # awaits it.
+    def writesteps(self, categoryid, entries):
+        now = time.time()
+        updated = []
+        # Hashes are replaced with DEL + HSET, which must not be observed halfway
+        pipeline = self.valkeyconnection.pipeline(transaction=self.hashstorage)
+        pipeline.sadd(self.categoryindexkey(), categoryid)
+        ttl = self.categorysetting(categoryid, 'ttl')
+        for entryid, entry in entries:
+            updated.append((entryid, self.queueupdate(pipeline, categoryid, entryid, entry, now, ttl)))
+        self.queuepublish(pipeline, categoryid, [ entryid for entryid, _ in updated ])
+        maxentries = self.categorysetting(categoryid, 'maxentries')
+        if maxentries:
+            pipeline.zcard(self.entryindexkey(categoryid))
+        results = yield 'write', pipeline.execute
+        logger.debug("updated %d entries in %s", len(updated), categoryid)
+        if maxentries and results[-1] > maxentries:
+            yield from self.evictsteps(categoryid, results[-1] - maxentries)
+        return updated
+
+    def evictsteps(self, categoryid, count):
+        # Oldest-first: the index is scored by last update time
+        popped = yield 'evict', lambda: self.valkeyconnection.zpopmin(self.entryindexkey(categoryid), count)
+        entryids = [ entryid.decode('utf-8') for entryid, _ in popped ]
+        if not entryids:
+            return
+        pipeline = self.valkeyconnection.pipeline(transaction=False)
+        self.queueremove(pipeline, categoryid, entryids)
+        yield 'evict', pipeline.execute
+        logger.debug("evicted %d entries from %s", len(entryids), categoryid)
+
+    def hashsteps(self, valkeykeys):
+        pipeline = self.valkeyconnection.pipeline(transaction=False)
+        for valkeykey in valkeykeys:
+            pipeline.hgetall(valkeykey)
+        return (yield 'hgetall', lambda: pipeline.execute(raise_on_error=False))
+
+    def fetchsteps(self, valkeykeys):
+        if not self.hashstorage:
+            values = yield 'mget', lambda: self.valkeyconnection.mget(valkeykeys)
+            # MGET returns nil for entries that were written as hashes
+            missing = [ index for index, value in enumerate(values) if value is None ]
+            if missing:
+                hashes = yield from self.hashsteps([ valkeykeys[index] for index in missing ])
+                for index, value in zip(missing, hashes):
+                    if isinstance(value, dict) and value:
+                        values[index] = value
+            return values
+
+        values = yield from self.hashsteps(valkeykeys)
+        # Entries written before switching to hashes are still strings (WRONGTYPE)
+        legacy = [ index for index, value in enumerate(values) if isinstance(value, Exception) ]
+        if legacy:
+            legacyvalues = yield 'mget', lambda: self.valkeyconnection.mget([ valkeykeys[index] for index in legacy ])
+            for index, value in zip(legacy, legacyvalues):
+                values[index] = value
+        return values
+
+    def batchsteps(self, query):
+        keys = [ (categoryid, entryid) for categoryid, entryids in query.items() for entryid in entryids ]
+        result = { categoryid: {} for categoryid in query.keys() }
+        if not keys:
+            return result
+        values = yield from self.fetchsteps([ self.entrykey(categoryid, entryid) for categoryid, entryid in keys ])
+        for (categoryid, entryid), valkeyval in zip(keys, values):
+            try:
+                result[categoryid][entryid] = self.decodeentry(valkeyval)
+            except:
+                logger.debug("Unable to decode %s/%s", categoryid, entryid)
+                result[categoryid][entryid] = None
+        return result
+
+    def entrysteps(self, categoryid, entryid):
+        result = yield from self.batchsteps({ categoryid: [ entryid ] })
+        return result[categoryid][entryid]
+
+    def fieldsteps(self, categoryid, entryid, field):
+        if self.hashstorage:
+            # A single field of a hash, without decoding the others
+            pipeline = self.valkeyconnection.pipeline(transaction=False)
+            pipeline.hmget(self.entrykey(categoryid, entryid), ['_codec', field])
+            # Strings written before switching to hashes answer WRONGTYPE
+            fetched, = yield 'hmget', lambda: pipeline.execute(raise_on_error=False)
+            if not isinstance(fetched, Exception):
+                codecname, value = fetched
+                if codecname is None or value is None:
+                    return None
+                return getcodec(codecname.decode('utf-8')).decode(value)
+        entry = yield from self.entrysteps(categoryid, entryid)
+        return entry[field] if entry and field in entry else None
+
+    def metasteps(self, categoryid, entryid):
+        pipeline = self.valkeyconnection.pipeline(transaction=False)
+        pipeline.zscore(self.entryindexkey(categoryid), entryid)
+        pipeline.hget(self.versionkey(categoryid), entryid)
+        updated, version = yield 'meta', pipeline.execute
+        return self.decodemeta(updated, version)
+
+    def decodemeta(self, updated, version):
+        if updated is None:
+            return None
+        return { 'version': int(version) if version is not None else 0, 'time': updated }
+
+    def entrymetasteps(self, categoryid, entryid):
+        # The metadata and the value in one pipeline
+        valkeykey = self.entrykey(categoryid, entryid)
+        pipeline = self.valkeyconnection.pipeline(transaction=False)
+        pipeline.zscore(self.entryindexkey(categoryid), entryid)
+        pipeline.hget(self.versionkey(categoryid), entryid)
+        if self.hashstorage:
+            pipeline.hgetall(valkeykey)
+        else:
+            pipeline.get(valkeykey)
+        updated, version, valkeyval = yield 'entrymeta', lambda: pipeline.execute(raise_on_error=False)
+        meta = self.decodemeta(updated, version)
+        if meta is None:
+            return None, None
+        # Entries written in the other layout answer WRONGTYPE and are read again
+        if isinstance(valkeyval, Exception):
+            return (yield from self.entrysteps(categoryid, entryid)), meta
         try:
-            categories = set()
-            keys = self.valkeyconnection.keys(f"{self.valkeyprefix}{self.delimiter}*")
-            for key in keys:
-                key_str = key.decode('utf-8')
-                logger.debug(f"Found key {key_str}")
-                if self.delimiter in key_str:
-                    parts = key_str.split(self.delimiter)
-                    logger.debug(f"Parts: {parts}")
-                    categories.add(parts[1])
-            return list(categories)
+            return self.decodeentry(valkeyval), meta
         except:
-            return []
-        
-    def listentries(self, categoryid):
-        logger.debug(f"Listing entries for {categoryid}")
+            logger.debug("Unable to decode %s/%s", categoryid, entryid)
+            return None, meta
+
+    def historysteps(self, categoryid, entryid, start=None, end=None, bucket=None, field='v'):
+        members = yield 'history', lambda: self.valkeyconnection.zrangebyscore(
+            self.historykey(categoryid, entryid),
+            start if start is not None else '-inf',
+            end if end is not None else '+inf')
+        points = []
+        for member in members:
+            writetime, entry = json.loads(member)
+            points.append(dict(entry, _time=writetime))
+        if bucket:
+            return downsample(points, bucket, field)
+        return points
+
+    def publishstatussteps(self, name, status, ttl):
+        # Lets other processes (e.g. API workers without ingestion) report on this one.
+        # The status disappears when the publisher stops refreshing it.
+        yield 'status', lambda: self.valkeyconnection.set(self.statuskey(name), json.dumps(status), ex=ttl)
+
+    def statussteps(self, name):
+        status = yield 'status', lambda: self.valkeyconnection.get(self.statuskey(name))
+        return json.loads(status) if status is not None else None
+
+    def categoriessteps(self):
+        categories = yield 'smembers', lambda: self.valkeyconnection.smembers(self.categoryindexkey())
+        return [ category.decode('utf-8') for category in categories ]
+
+    def entriessteps(self, categoryid, since=None, start=0, count=None):
+        logger.debug("Listing entries for %s since %s (%s, %s)", categoryid, since, start, count)
+        # Entries are scored by their last update time, oldest first
+        entries = yield 'zrangebyscore', lambda: self.valkeyconnection.zrangebyscore(
+            self.entryindexkey(categoryid),
+            f"({since}" if since is not None else '-inf',
+            '+inf',
+            start=start,
+            num=count if count is not None else -1)
+        return [ entry.decode('utf-8') for entry in entries ]
+
+class ValkeyCacher(ValkeyLayout, BaseCacher):
+    def __init__(self, settings, delimiter=':'):
+        pool = valkey.BlockingConnectionPool(**poolsettings(settings))
+        self.valkeyconnection = valkey.Valkey(connection_pool=pool)
+        logger.info(f"Connecting to valkey {settings['host']}:{settings['port']} with at most {pool.max_connections} connections")
+        self.configure(settings, delimiter)
+        self.subscribers = []
+        self.subscriberthread = None
+        self.sweepinterval = settings['sweepinterval'] if 'sweepinterval' in settings else 60
+        self.sweeperthread = None
+        self.ensureindex()
+
+    def run(self, steps):
+        # Executes the round trips of a ValkeyLayout step generator
+        result = None
         try:
-            entries = set()
-            keys = self.valkeyconnection.keys(f"{self.valkeyprefix}{self.delimiter}{categoryid}{self.delimiter}*")
-            for key in keys:
-                key_str = key.decode('utf-8')
-                logger.debug(f"Found key {key_str}")
-                if self.delimiter in key_str:
-                    parts = key_str.split(self.delimiter)
-                    logger.debug(f"Parts: {parts}")
-                    entries.add(parts[2])
-            return list(entries)
+            while True:
+                name, call = steps.send(result)
+                with self.command(name):
+                    result = call()
+        except StopIteration as stop:
+            return stop.value
+
+    def ensureindex(self):
+        # Caches written before the index existed only have the plain entry keys.
+        # Walk them once (with SCAN, not KEYS) so the listings stay complete.
+        try:
+            if self.valkeyconnection.exists(self.categoryindexkey()):
+                return
+            self.rebuildindex()
         except:
-            return []
\ No newline at end of file
+            logger.exception("Unable to verify category index")
+
+    def rebuildindex(self):
+        logger.info(f"Rebuilding category index for {self.valkeyprefix}")
+        now = time.time()
+        count = 0
+        pipeline = self.valkeyconnection.pipeline(transaction=False)
+        for key in self.valkeyconnection.scan_iter(match=f"{self.valkeyprefix}{self.delimiter}*", count=1000):
+            parts = key.decode('utf-8').split(self.delimiter, 2)
+            if len(parts) < 3 or parts[1].startswith('_'):
+                continue
+            pipeline.sadd(self.categoryindexkey(), parts[1])
+            pipeline.zadd(self.entryindexkey(parts[1]), {parts[2]: now}, nx=True)
+            count += 1
+        pipeline.execute()
+        logger.info(f"Indexed {count} entries for {self.valkeyprefix}")
+
+    def configurecategory(self, categoryid, settings):
+        self.categorysettings[categoryid] = settings
+        if 'history' in settings:
+            logger.info(f"Keeping history for {categoryid}: {settings['history']}")
+        if 'ttl' in settings or 'maxentries' in settings:
+            logger.info(f"Expiring entries of {categoryid} after {self.categorysetting(categoryid, 'ttl')}s, keeping at most {self.categorysetting(categoryid, 'maxentries')}")
+
+    def startsweeper(self):
+        # Only the ingesting process sweeps, API workers leave the index alone
+        if self.sweeperthread or not self.sweepinterval:
+            return
+        if not any('ttl' in settings or 'maxentries' in settings for settings in self.categorysettings.values()):
+            return
+        self.sweeperthread = threading.Thread(target=self.sweepperiodically, daemon=True)
+        self.sweeperthread.start()
+
+    def updatecache(self, categoryid, entryid, entry):
+        return self.updatecachemany(categoryid, [ (entryid, entry) ])[0][1]
+
+    def updatecachemany(self, categoryid, entries):
+        return self.run(self.writesteps(categoryid, entries))
+
+    def preheat(self, query):
+        now = time.time()
+        keys = [ (categoryid, entryid, entry) for categoryid, entries in query.items() for entryid, entry in entries.items() ]
+        if not keys:
+            return []
+        pipeline = self.valkeyconnection.pipeline(transaction=False)
+        if self.hashstorage:
+            with self.command('preheat'):
+                writes = self.preheathashes(keys, now)
+        else:
+            # NX also leaves entries alone that were written as hashes
+            for categoryid, entryid, entry in keys:
+                entry, meta = self.splitmeta(entry, now)
+                pipeline.set(self.entrykey(categoryid, entryid), self.codec.encode({ 'entry': entry, 'meta': meta }),
+                             nx=True, ex=self.categorysetting(categoryid, 'ttl'))
+            with self.command('preheat'):
+                writes = [ bool(written) for written in pipeline.execute() ]
+            pipeline = self.valkeyconnection.pipeline(transaction=False)
+            for (categoryid, entryid, entry), write in zip(keys, writes):
+                if write:
+                    self.queueindex(pipeline, categoryid, entryid, now)
+
+        written = [ (categoryid, entryid) for (categoryid, entryid, entry), write in zip(keys, writes) if write ]
+        for categoryid in set(categoryid for categoryid, entryid in written):
+            pipeline.sadd(self.categoryindexkey(), categoryid)
+            self.queuepublish(pipeline, categoryid, [ entryid for writtencategory, entryid in written if writtencategory == categoryid ], origin=False)
+        if written:
+            with self.command('preheat'):
+                pipeline.execute()
+        return written
+
+    def preheathashes(self, keys, now):
+        # Hashes cannot be created with NX: the keys are watched while checking for
+        # existing keys (of either layout), so a write from a consumer in between
+        # aborts the transaction and the check is repeated
+        valkeykeys = [ self.entrykey(categoryid, entryid) for categoryid, entryid, entry in keys ]
+        while True:
+            with self.valkeyconnection.pipeline(transaction=True) as pipeline:
+                try:
+                    pipeline.watch(*valkeykeys)
+                    # The checks are sent at once on the watched connection, which is
+                    # what a pipeline does but without putting it into MULTI mode
+                    connection = pipeline.connection
+                    connection.send_packed_command(connection.pack_commands([ ('EXISTS', valkeykey) for valkeykey in valkeykeys ]))
+                    writes = [ not pipeline.parse_response(connection, 'EXISTS') for valkeykey in valkeykeys ]
+                    if not any(writes):
+                        return writes
+                    pipeline.multi()
+                    for (categoryid, entryid, entry), write in zip(keys, writes):
+                        if write:
+                            self.queueupdate(pipeline, categoryid, entryid, entry, now, self.categorysetting(categoryid, 'ttl'))
+                    pipeline.execute()
+                    return writes
+                except valkey.exceptions.WatchError:
+                    logger.debug("entries changed while preheating, checking again")
+
+    def evict(self, categoryid, count):
+        self.run(self.evictsteps(categoryid, count))
+
+    def sweep(self):
+        # Entry keys expire by themselves, their index, version and history entries are
+        # removed here. Categories left without entries are dropped from the index.
+        now = time.time()
+        removed = 0
+        for categoryid in self.listcategories():
+            ttl = self.categorysetting(categoryid, 'ttl')
+            if ttl:
+                with self.command('sweep'):
+                    expired = self.valkeyconnection.zrangebyscore(self.entryindexkey(categoryid), '-inf', now - ttl)
+                    entryids = [ entryid.decode('utf-8') for entryid in expired ]
+                    for start in range(0, len(entryids), 500):
+                        removed += self.sweepentries(categoryid, entryids[start:start + 500], now - ttl)
+            with self.command('sweep'):
+                self.sweepcategory(categoryid)
+        if removed:
+            logger.info(f"Swept {removed} expired entries")
+        return removed
+
+    def sweepentries(self, categoryid, entryids, cutoff, attempts=3):
+        # Entries written since ZRANGEBYSCORE must survive: the entry keys are watched and
+        # the scores checked again, any write in between aborts the removal and the
+        # batch is retried (or left to the next sweep)
+        keys = [ self.entrykey(categoryid, entryid) for entryid in entryids ]
+        for attempt in range(attempts):
+            with self.valkeyconnection.pipeline(transaction=True) as pipeline:
+                try:
+                    pipeline.watch(*keys)
+                    scores = pipeline.zmscore(self.entryindexkey(categoryid), entryids)
+                    expired = [ entryid for entryid, score in zip(entryids, scores) if score is not None and score <= cutoff ]
+                    if not expired:
+                        return 0
+                    pipeline.multi()
+                    self.queueremove(pipeline, categoryid, expired)
+                    pipeline.execute()
+                    return len(expired)
+                except valkey.exceptions.WatchError:
+                    logger.debug("entries of %s changed while sweeping, attempt %d", categoryid, attempt + 1)
+        return 0
+
+    def sweepcategory(self, categoryid):
+        # Dropped only if no write added an entry since ZCARD
+        with self.valkeyconnection.pipeline(transaction=True) as pipeline:
+            try:
+                pipeline.watch(self.entryindexkey(categoryid))
+                if pipeline.zcard(self.entryindexkey(categoryid)) != 0:
+                    return
+                pipeline.multi()
+                pipeline.srem(self.categoryindexkey(), categoryid)
+                pipeline.delete(self.versionkey(categoryid))
+                pipeline.execute()
+                logger.info(f"Removed empty category {categoryid}")
+            except valkey.exceptions.WatchError:
+                pass
+
+    def sweepperiodically(self):
+        while True:
+            time.sleep(self.sweepinterval)
+            try:
+                self.sweep()
+            except:
+                logger.exception("Sweeping expired entries failed")
+
+    def subscribe(self, callback):
+        # callback(categoryid, entryids, local) is called for every update published
+        # by any process sharing this prefix. categoryid None means "anything may have
+        # changed", which is sent whenever the subscription is (re)established.
+        self.subscribers.append(callback)
+        if not self.subscriberthread:
+            self.subscriberthread = threading.Thread(target=self.readupdates, daemon=True)
+            self.subscriberthread.start()
+
+    def notifysubscribers(self, categoryid, entryids, local):
+        for callback in self.subscribers:
+            try:
+                callback(categoryid, entryids, local)
+            except:
+                logger.exception("Update subscriber %s failed", callback)
+
+    def readupdates(self):
+        while True:
+            try:
+                pubsub = self.valkeyconnection.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.updatechannel())
+                logger.info(f"Subscribed to {self.updatechannel()}")
+                self.notifysubscribers(None, None, False)
+                while True:
+                    # Polling instead of listen() keeps the socket timeout and health checks working
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is None or message['type'] != 'message':
+                        continue
+                    update = json.loads(message['data'])
+                    self.notifysubscribers(update['category'], update['entries'], update['origin'] == self.origin)
+            except:
+                logger.exception(f"Lost subscription to {self.updatechannel()}, retrying")
+                time.sleep(1)
+
+    def getentry(self, categoryid, entryid):
+        return self.run(self.entrysteps(categoryid, entryid))
+
+    def getfield(self, categoryid, entryid, field):
+        return self.run(self.fieldsteps(categoryid, entryid, field))
+
+    def getentries(self, categoryid, entryids):
+        return self.getentriesbatch({ categoryid: entryids })[categoryid]
+
+    def getentriesbatch(self, query):
+        return self.run(self.batchsteps(query))
+
+    def getentrymeta(self, categoryid, entryid):
+        return self.run(self.metasteps(categoryid, entryid))
+
+    def getentrywithmeta(self, categoryid, entryid):
+        return self.run(self.entrymetasteps(categoryid, entryid))
+
+    def gethistory(self, categoryid, entryid, start=None, end=None, bucket=None, field='v'):
+        return self.run(self.historysteps(categoryid, entryid, start, end, bucket, field))
+
+    def categoryreport(self, samples=10):
+        # Memory use is estimated from MEMORY USAGE of a random sample of each category's entries
+        report = {}
+        for categoryid in self.listcategories():
+            entryindexkey = self.entryindexkey(categoryid)
+            pipeline = self.valkeyconnection.pipeline(transaction=False)
+            pipeline.zcard(entryindexkey)
+            pipeline.zrandmember(entryindexkey, samples)
+            pipeline.memory_usage(entryindexkey)
+            pipeline.memory_usage(self.versionkey(categoryid))
+            with self.command('report'):
+                entries, sampled, indexbytes, versionbytes = pipeline.execute(raise_on_error=False)
+                sampled = sampled if isinstance(sampled, list) else []
+                pipeline = self.valkeyconnection.pipeline(transaction=False)
+                for entryid in sampled:
+                    pipeline.memory_usage(self.entrykey(categoryid, entryid.decode('utf-8')))
+                sizes = [ size for size in pipeline.execute(raise_on_error=False) if isinstance(size, int) ]
+            report[categoryid] = {
+                'entries': entries,
+                'sampled': len(sizes),
+                'entrybytes': int(sum(sizes) / len(sizes) * entries) if sizes else None,
+                'indexbytes': sum(size for size in (indexbytes, versionbytes) if isinstance(size, int)) if isinstance(indexbytes, int) else None,
+                'ttl': self.categorysetting(categoryid, 'ttl'),
+                'maxentries': self.categorysetting(categoryid, 'maxentries'),
+            }
+        return report
+
+    def connectionsettings(self):
+        return self.settings
+
+    def publishstatus(self, name, status, ttl):
+        self.run(self.publishstatussteps(name, status, ttl))
+
+    def getstatus(self, name):
+        return self.run(self.statussteps(name))
+
+    def listcategories(self):
+        return self.run(self.categoriessteps())
+
+    def listentries(self, categoryid, since=None, start=0, count=None):
+        return self.run(self.entriessteps(categoryid, since, start, count))
+
+
+class LocalCacher(BaseCacher):
+    # Bounded in-process LRU in front of another cacher. Writes made through this
+    # process populate it directly; writes from other processes invalidate it
+    # through the backend's update notifications.
+    def __init__(self, backend, size=1024, ttl=30):
+        self.backend = backend
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.metas = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        backend.subscribe(self.invalidate)
+        logger.info(f"Local cache enabled (size={size}, ttl={ttl})")
+
+    def store(self, categoryid, entryid, value, entries=None):
+        # Caller holds self.lock
+        entries = self.entries if entries is None else entries
+        entries[(categoryid, entryid)] = (time.monotonic() + self.ttl, value)
+        entries.move_to_end((categoryid, entryid))
+        while len(entries) > self.size:
+            entries.popitem(last=False)
+
+    def invalidate(self, categoryid, entryids, local):
+        if local:
+            return
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            if categoryid is None:
+                self.entries.clear()
+                self.metas.clear()
+            else:
+                for entryid in entryids:
+                    self.entries.pop((categoryid, entryid), None)
+                    self.metas.pop((categoryid, entryid), None)
+
+    def getentry(self, categoryid, entryid):
+        with self.lock:
+            cached = self.entries.get((categoryid, entryid))
+            if cached and cached[0] > time.monotonic():
+                self.entries.move_to_end((categoryid, entryid))
+                self.hits += 1
+                metrics.localcache.labels('hit').inc()
+                return dict(cached[1])
+            self.misses += 1
+            metrics.localcache.labels('miss').inc()
+            generation = self.generation
+
+        value = self.backend.getentry(categoryid, entryid)
+        if value is not None:
+            with self.lock:
+                # Skip caching if an invalidation raced with the backend read
+                if generation == self.generation:
+                    self.store(categoryid, entryid, dict(value))
+        return value
+
+    def getentries(self, categoryid, entryids):
+        return self.getentriesbatch({ categoryid: entryids })[categoryid]
+
+    def getentriesbatch(self, query):
+        result = {}
+        missing = {}
+        now = time.monotonic()
+        with self.lock:
+            generation = self.generation
+            for categoryid, entryids in query.items():
+                result[categoryid] = {}
+                for entryid in entryids:
+                    cached = self.entries.get((categoryid, entryid))
+                    if cached and cached[0] > now:
+                        self.entries.move_to_end((categoryid, entryid))
+                        self.hits += 1
+                        metrics.localcache.labels('hit').inc()
+                        result[categoryid][entryid] = dict(cached[1])
+                    else:
+                        self.misses += 1
+                        metrics.localcache.labels('miss').inc()
+                        missing.setdefault(categoryid, []).append(entryid)
+
+        if missing:
+            fetched = self.backend.getentriesbatch(missing)
+            with self.lock:
+                for categoryid, values in fetched.items():
+                    result[categoryid].update(values)
+                    if generation == self.generation:
+                        for entryid, value in values.items():
+                            if value is not None:
+                                self.store(categoryid, entryid, dict(value))
+        return result
+
+    def updatecache(self, categoryid, entryid, entry):
+        return self.updatecachemany(categoryid, [ (entryid, entry) ])[0][1]
+
+    def updatecachemany(self, categoryid, entries):
+        updated = self.backend.updatecachemany(categoryid, entries)
+        with self.lock:
+            for entryid, value in updated:
+                self.store(categoryid, entryid, dict(value))
+                self.metas.pop((categoryid, entryid), None)
+        return updated
+
+    def getentrymeta(self, categoryid, entryid):
+        with self.lock:
+            cached = self.metas.get((categoryid, entryid))
+            if cached and cached[0] > time.monotonic():
+                self.hits += 1
+                metrics.localcache.labels('hit').inc()
+                return cached[1]
+            self.misses += 1
+            metrics.localcache.labels('miss').inc()
+            generation = self.generation
+
+        meta = self.backend.getentrymeta(categoryid, entryid)
+        if meta is not None:
+            with self.lock:
+                if generation == self.generation:
+                    self.store(categoryid, entryid, meta, self.metas)
+        return meta
+
+    def getentrywithmeta(self, categoryid, entryid):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.entries.get((categoryid, entryid))
+            cachedmeta = self.metas.get((categoryid, entryid))
+            if cached and cached[0] > now and cachedmeta and cachedmeta[0] > now:
+                self.entries.move_to_end((categoryid, entryid))
+                self.hits += 1
+                metrics.localcache.labels('hit').inc()
+                return dict(cached[1]), cachedmeta[1]
+            self.misses += 1
+            metrics.localcache.labels('miss').inc()
+            generation = self.generation
+
+        value, meta = self.backend.getentrywithmeta(categoryid, entryid)
+        if meta is not None:
+            with self.lock:
+                if generation == self.generation:
+                    self.store(categoryid, entryid, meta, self.metas)
+                    if value is not None:
+                        self.store(categoryid, entryid, dict(value))
+        return value, meta
+
+    def listcategories(self):
+        return self.backend.listcategories()
+
+    def listentries(self, categoryid, since=None, start=0, count=None):
+        return self.backend.listentries(categoryid, since=since, start=start, count=count)
+
+    def configurecategory(self, categoryid, settings):
+        self.backend.configurecategory(categoryid, settings)
+
+    def startsweeper(self):
+        self.backend.startsweeper()
+
+    def preheat(self, query):
+        # Published without an origin, so the local copies are invalidated
+        return self.backend.preheat(query)
+
+    def categoryreport(self, samples=10):
+        return self.backend.categoryreport(samples)
+
+    def publishstatus(self, name, status, ttl):
+        self.backend.publishstatus(name, status, ttl)
+
+    def getstatus(self, name):
+        return self.backend.getstatus(name)
+
+    def connectionsettings(self):
+        return self.backend.connectionsettings()
+
+    def gethistory(self, categoryid, entryid, start=None, end=None, bucket=None, field='v'):
+        return self.backend.gethistory(categoryid, entryid, start=start, end=end, bucket=bucket, field=field)
+
+    def subscribe(self, callback):
+        self.backend.subscribe(callback)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'maxsize': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+            }
+
+
+class CoalescingCacher(BaseCacher):
+    # Sits between a handler and the cacher and drops writes that do not change
+    # anything. An unchanged value is only rewritten every `refresh` seconds so its
+    # write time keeps showing that the sensor is alive; `_meta.changed` records when
+    # the value last actually changed. A changed value is written at most once per
+    # `mininterval` seconds (the latest value wins). With a `flushinterval`, writes
+    # are buffered and sent in batches every flushinterval seconds or once `flushsize`
+    # writes are pending; without it every eligible write is sent immediately. Buffered
+    # writes of already acknowledged messages are lost if the process dies.
+    def __init__(self, backend, refresh=60, mininterval=0, flushinterval=0, flushsize=100, ignore=()):
+        self.backend = backend
+        # Fields such as a SenML time 't' that change with every message but should not
+        # count as a change of value
+        self.ignore = set(ignore)
+        self.refresh = refresh
+        self.mininterval = mininterval
+        self.flushinterval = flushinterval
+        self.flushsize = flushsize
+        self.state = {}
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.flushlock = threading.Lock()
+        self.received = 0
+        self.written = 0
+        period = flushinterval or mininterval
+        if period:
+            flusher = threading.Thread(target=self.flushperiodically, args=(period,), daemon=True)
+            flusher.start()
+        logger.info(f"Coalescing writes (refresh={refresh}, mininterval={mininterval}, flushinterval={flushinterval}, flushsize={flushsize})")
+
+    def updatecache(self, categoryid, entryid, entry):
+        self.updatecachemany(categoryid, [ (entryid, entry) ])
+
+    def updatecachemany(self, categoryid, entries):
+        now = time.time()
+        with self.lock:
+            for entryid, entry in entries:
+                self.received += 1
+                key = (categoryid, entryid)
+                # state only describes what was written successfully; a pending write is
+                # compared against first as it is what will be written next
+                state = self.state[key] if key in self.state else None
+                latest = self.pending[key] if key in self.pending else state
+                compared = { field: value for field, value in entry.items() if field not in self.ignore }
+                changed = latest is None or latest['compared'] != compared
+                changedtime = now if changed else latest['changed']
+                written = state['written'] if state is not None else 0
+
+                if changed:
+                    notbefore = written + self.mininterval
+                elif key in self.pending or now - written < self.refresh:
+                    continue
+                else:
+                    notbefore = now
+
+                self.pending[key] = {
+                    'notbefore': notbefore,
+                    'entry': dict(entry, _meta={ 'changed': datetime.fromtimestamp(changedtime).isoformat() }),
+                    'compared': compared,
+                    'changed': changedtime
+                }
+                self.pending.move_to_end(key)
+
+            due = not self.flushinterval or len(self.pending) >= self.flushsize
+        if due:
+            self.flush()
+        return []
+
+    def flush(self):
+        # flushlock keeps consecutive flushes of the same entry in order
+        with self.flushlock:
+            now = time.time()
+            with self.lock:
+                ready = OrderedDict()
+                for key, pending in list(self.pending.items()):
+                    if pending['notbefore'] <= now:
+                        ready[key] = pending
+                        del self.pending[key]
+            bycategory = {}
+            for (categoryid, entryid), pending in ready.items():
+                bycategory.setdefault(categoryid, []).append(entryid)
+            for categoryid, entryids in list(bycategory.items()):
+                try:
+                    self.backend.updatecachemany(categoryid, [ (entryid, ready[(categoryid, entryid)]['entry']) for entryid in entryids ])
+                except:
+                    # Keep the unwritten entries (unless a newer value arrived meanwhile) so
+                    # a redelivered message or the next flush writes them after all
+                    with self.lock:
+                        for key, pending in ready.items():
+                            if key[0] in bycategory and key not in self.pending:
+                                self.pending[key] = pending
+                    raise
+                with self.lock:
+                    for entryid in entryids:
+                        pending = ready[(categoryid, entryid)]
+                        self.state[(categoryid, entryid)] = { 'compared': pending['compared'], 'changed': pending['changed'], 'written': now }
+                    self.written += len(entryids)
+                del bycategory[categoryid]
+
+    def flushperiodically(self, period):
+        while True:
+            time.sleep(period)
+            try:
+                self.flush()
+            except:
+                logger.exception("Unable to flush coalesced writes")
+
+    def getentry(self, categoryid, entryid):
+        return self.backend.getentry(categoryid, entryid)
+
+    def getentries(self, categoryid, entryids):
+        return self.backend.getentries(categoryid, entryids)
+
+    def listcategories(self):
+        return self.backend.listcategories()
+
+    def listentries(self, categoryid, since=None, start=0, count=None):
+        return self.backend.listentries(categoryid, since=since, start=start, count=count)
+
+    def stats(self):
+        with self.lock:
+            return { 'received': self.received, 'written': self.written, 'pending': len(self.pending) }
+
+
+def preheatcache(cacher, settings):
+    # Collects the preheat values of all queues and writes the missing ones in one batch
+    query = {}
+    for queuetype in settings.keys():
+        if isinstance(settings[queuetype], Mapping):
+            for queueid in settings[queuetype].keys():
+                if isinstance(settings[queuetype][queueid], Mapping) and 'preheat' in settings[queuetype][queueid]:
+                    query[queueid] = settings[queuetype][queueid]['preheat']
+    written = cacher.preheat(query) if query else []
+    logger.info(f"preheat: wrote {len(written)} of {sum(len(entries) for entries in query.values())} entries, others were cached already")
+    logger.debug(f"preheat: wrote {written}")
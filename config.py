@@ -0,0 +1,22 @@
+import yaml
+import logging
+import logging.config
+
+import os
+from dotenv import load_dotenv
+
+def configurelogging():
+    load_dotenv()
+    loggingconfig = os.getenv("LOGCONFIG")
+
+    print(f"Starting configuring logging using: {loggingconfig}")
+    with open(loggingconfig) as logyaml:
+        logconfig = yaml.safe_load(logyaml)
+    logging.config.dictConfig(logconfig)
+
+def loadsettings():
+    load_dotenv()
+    cacheconfig = os.getenv("CACHECONFIG")
+
+    with open(cacheconfig,"r") as settingsfile:
+        return yaml.safe_load(settingsfile)
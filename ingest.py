@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+# Configure logging before importing anything!
+from config import configurelogging, loadsettings
+configurelogging()
+
+# Now do other stuff
+
+import os
+import time
+from logging import getLogger
+from queue import Queue
+
+from rabbitlistener import createlistener, WorkerPool
+from cacher import ValkeyCacher, preheatcache
+import metrics
+
+logger = getLogger("ingest")
+
+def main():
+    # Dedicated ingestion process: consumes the configured queues and writes to the
+    # cache, so the API can run with INGEST=0 in as many workers as needed.
+    settings = loadsettings()
+    logger.debug(f"settings={settings}")
+
+    metricsport = os.getenv("METRICSPORT")
+    if metricsport:
+        logger.info(f"Serving metrics on port {metricsport}")
+        metrics.serve(int(metricsport))
+
+    cacher = ValkeyCacher(settings['valkey'])
+    # Spawned worker processes import this module without running main()
+    WorkerPool.allowprocesses = True
+    rabbitlistener = createlistener(cacher, Queue(), settings['rabbitqueues'])
+    logger.info("Starting queue thread")
+    rabbitlistener.start()
+    logger.info("rabbitlistener queue thread started")
+    cacher.startsweeper()
+
+    logger.info("Preheating cache")
+    preheatcache(cacher, settings)
+    logger.info("Preheated cache")
+
+    # API workers running with INGEST=0 base their readiness on this status
+    statusinterval = int(os.getenv("STATUSINTERVAL", "10"))
+    while True:
+        try:
+            cacher.publishstatus('ingest', rabbitlistener.status(), ttl=3 * statusinterval)
+        except Exception:
+            logger.exception("Unable to publish ingest status")
+        time.sleep(statusinterval)
+
+if __name__ == "__main__":
+    main()
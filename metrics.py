@@ -0,0 +1,34 @@
+import os
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, CollectorRegistry, CONTENT_TYPE_LATEST, generate_latest, start_http_server
+from prometheus_client import multiprocess
+
+# Ingest
+messagesconsumed = Counter('homeapi_messages_consumed', 'Messages received from RabbitMQ', ['queue'])
+messagesacked = Counter('homeapi_messages_acked', 'Messages processed and acknowledged', ['queue'])
+messagesfailed = Counter('homeapi_messages_failed', 'Messages whose handler raised', ['queue'])
+handlerlatency = Histogram('homeapi_handler_seconds', 'Time spent in Handler.handlemessage', ['queue'])
+senmlrecords = Counter('homeapi_senml_records', 'SenML records written to the cache', ['queue'])
+consumerup = Gauge('homeapi_consumer_up', 'Whether the queue is being consumed', ['queue'])
+consumerreconnects = Counter('homeapi_consumer_reconnects', 'Reconnects of the queue consumer', ['queue'])
+queuelag = Gauge('homeapi_queue_lag', 'Messages waiting in the queue', ['queue'])
+
+# Cache
+valkeylatency = Histogram('homeapi_valkey_seconds', 'Valkey round-trip latency', ['command'],
+                          buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1))
+localcache = Counter('homeapi_localcache_requests', 'Local cache lookups', ['result'])
+
+# HTTP
+httplatency = Histogram('homeapi_http_request_seconds', 'HTTP request latency', ['method', 'route', 'status'])
+
+def exposition():
+    # With several gunicorn workers set PROMETHEUS_MULTIPROC_DIR so every worker's
+    # samples are aggregated instead of reporting whichever worker answered the scrape.
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+def serve(port):
+    start_http_server(port)
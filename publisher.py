@@ -0,0 +1,94 @@
+import threading
+import pika
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+class PublisherPool(object):
+    # Keeps publishing connections to a broker open between requests. BlockingConnection
+    # is not thread-safe, so each caller borrows a connection/channel pair for the
+    # duration of a single publish.
+    # Idle BlockingConnections do not answer heartbeats, so the broker would close them
+    # after a heartbeat timeout and nearly every occasional publish would first fail and
+    # reconnect. Heartbeats are therefore off and TCP keepalive detects dead peers.
+    def __init__(self, settings, size=4, confirm=False):
+        mqrabbit_credentials = pika.PlainCredentials(settings['MQRABBIT_USER'], settings['MQRABBIT_PASSWORD'])
+        self.parameters = pika.ConnectionParameters(
+            host=settings['MQRABBIT_HOST'],
+            virtual_host=settings['MQRABBIT_VHOST'],
+            port=settings['MQRABBIT_PORT'],
+            credentials=mqrabbit_credentials,
+            heartbeat=0,
+            tcp_options={ 'TCP_KEEPIDLE': 60, 'TCP_KEEPINTVL': 10, 'TCP_KEEPCNT': 3 })
+        self.size = size
+        self.confirm = confirm
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        logger.info(f"Opening publisher connection to {self.parameters.host}:{self.parameters.port}")
+        connection = pika.BlockingConnection(self.parameters)
+        channel = connection.channel()
+        if self.confirm:
+            channel.confirm_delivery()
+        return connection, channel
+
+    def acquire(self):
+        self.slots.acquire()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        try:
+            return self.connect()
+        except:
+            self.slots.release()
+            raise
+
+    def release(self, pair, broken=False):
+        if broken:
+            try:
+                pair[0].close()
+            except Exception:
+                pass
+        else:
+            with self.lock:
+                self.idle.append(pair)
+        self.slots.release()
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        # An idle pooled connection may have been closed in the meantime (broker restart,
+        # keepalive failure), so a failing publish is retried once on a fresh connection.
+        # Without confirms a publish on a connection that died unnoticed can be lost.
+        for attempt in range(2):
+            pair = self.acquire()
+            connection, channel = pair
+            try:
+                # Notices a close from the broker that arrived while the connection was idle
+                connection.process_data_events(0)
+                channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+            except (pika.exceptions.UnroutableError, pika.exceptions.NackError):
+                self.release(pair)
+                raise
+            except (pika.exceptions.AMQPError, OSError) as exc:
+                self.release(pair, broken=True)
+                if attempt:
+                    raise
+                logger.warning(f"Publish to [{exchange}] failed ({exc!r}), reconnecting")
+            else:
+                self.release(pair)
+                return
+
+
+publishers = {}
+publisherslock = threading.Lock()
+
+def getpublisher(settings):
+    key = (settings['MQRABBIT_HOST'], settings['MQRABBIT_PORT'], settings['MQRABBIT_VHOST'], settings['MQRABBIT_USER'])
+    with publisherslock:
+        if key not in publishers:
+            size = settings['MQRABBIT_PUBLISHPOOL'] if 'MQRABBIT_PUBLISHPOOL' in settings else 4
+            confirm = settings['MQRABBIT_CONFIRM'] if 'MQRABBIT_CONFIRM' in settings else False
+            logger.info(f"Creating publisher pool for {key[0]}:{key[1]}{key[2]} (size={size}, confirm={confirm})")
+            publishers[key] = PublisherPool(settings, size=size, confirm=confirm)
+        return publishers[key]
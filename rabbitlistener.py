@@ -1,21 +1,317 @@
 import threading
 from time import sleep
+import time
+import zlib
+import random
+import multiprocessing
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import pika
 import secrets
 import json
+import logging
 from logging import getLogger
+from publisher import getpublisher
+from cacher import ValkeyCacher, CoalescingCacher
+import metrics
 
 logger = getLogger(__name__)
 
+def senmlrecords(senml):
+    # Resolve the base name of each record in a SenML pack into (entryid, record) pairs
+    records = []
+    bn = None
+    for message in senml:
+        if 'bn' in message:
+            bn = message['bn']
+            del message['bn']
+
+        if 'n' in message:
+            entryid = f"{bn}{message['n']}"
+            message['bn'] = bn
+            records.append((entryid, message))
+    return records
+
+def senmlshardkey(senml):
+    # Packs normally come from one device, key on the name of the first record
+    if not isinstance(senml, list) or not senml or not isinstance(senml[0], dict):
+        return None
+    return f"{senml[0]['bn'] if 'bn' in senml[0] else ''}{senml[0]['n'] if 'n' in senml[0] else ''}"
+
+class Acknowledger(object):
+    # Acknowledges deliveries once their handler finished. With a batch size above one,
+    # acks are collected and sent as a single multiple=True ack every batchsize
+    # messages or after interval seconds, whichever comes first.
+    # Worker pools finish deliveries out of order, so a batch only ever reaches up to
+    # the watermark below which every delivery has been settled. When the channel is
+    # reopened, reset() starts over and completions dispatched before are dropped.
+    def __init__(self, channel, schedule, batchsize=1, interval=0.2):
+        self.channel = channel
+        self.schedule = schedule
+        self.batchsize = batchsize
+        self.interval = interval
+        self.pending = None
+        self.count = 0
+        self.timerset = False
+        self.watermark = 0
+        self.settled = {}
+        self.generation = 0
+
+    @classmethod
+    def fromsettings(cls, channel, schedule, settings, logger):
+        batchsize = settings['MQRABBIT_ACKBATCH'] if 'MQRABBIT_ACKBATCH' in settings else 1
+        interval = settings['MQRABBIT_ACKINTERVAL'] if 'MQRABBIT_ACKINTERVAL' in settings else 200
+        logger.info(f"Acknowledging in batches of {batchsize} or every {interval}ms")
+        return cls(channel, schedule, batchsize, interval / 1000)
+
+    def ack(self, delivery_tag):
+        if self.batchsize <= 1:
+            self.channel.basic_ack(delivery_tag=delivery_tag)
+            return
+
+        self.settle(delivery_tag, True)
+        self.count += 1
+        if self.count >= self.batchsize:
+            self.flush()
+        elif not self.timerset:
+            self.timerset = True
+            self.schedule(self.interval, self.ontimer)
+
+    def nack(self, delivery_tag, requeue):
+        self.flush()
+        if self.batchsize > 1:
+            self.settle(delivery_tag, False)
+        self.channel.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
+
+    def settle(self, delivery_tag, acked):
+        # Delivery tags are consecutive per channel, starting at 1
+        self.settled[delivery_tag] = acked
+        while self.watermark + 1 in self.settled:
+            self.watermark += 1
+            if self.settled.pop(self.watermark):
+                # Only an acked delivery can end a multiple=True ack
+                self.pending = self.watermark
+
+    def reset(self):
+        # Delivery tags restart at 1 on a reopened channel, and the deliveries of the old
+        # channel can no longer be acknowledged: the broker redelivers them
+        self.generation += 1
+        self.pending = None
+        self.count = 0
+        self.watermark = 0
+        self.settled = {}
+
+    def current(self, generation):
+        return generation == self.generation
+
+    def ontimer(self):
+        self.timerset = False
+        self.flush()
+
+    def flush(self):
+        if self.pending is not None:
+            self.channel.basic_ack(delivery_tag=self.pending, multiple=True)
+            self.pending = None
+            self.count = 0
+
+
+def prefetchcount(settings, logger):
+    prefetch = settings['MQRABBIT_PREFETCH'] if 'MQRABBIT_PREFETCH' in settings else 100
+    batchsize = settings['MQRABBIT_ACKBATCH'] if 'MQRABBIT_ACKBATCH' in settings else 1
+    if prefetch <= batchsize:
+        logger.warning(f"Prefetch {prefetch} does not exceed ack batch {batchsize}, batches will only be flushed by the timer")
+    logger.info(f"Using prefetch count {prefetch}")
+    return prefetch
+
+class Backoff(object):
+    # Jittered exponential delays between reconnect attempts
+    def __init__(self, minimum=1, maximum=60):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.attempts = 0
+
+    @classmethod
+    def fromsettings(cls, settings):
+        minimum = settings['MQRABBIT_RECONNECTMIN'] if 'MQRABBIT_RECONNECTMIN' in settings else 1
+        maximum = settings['MQRABBIT_RECONNECTMAX'] if 'MQRABBIT_RECONNECTMAX' in settings else 60
+        return cls(minimum, maximum)
+
+    def next(self):
+        delay = min(self.maximum, self.minimum * 2 ** self.attempts)
+        self.attempts += 1
+        return random.uniform(delay / 2, delay)
+
+    def reset(self):
+        self.attempts = 0
+
+class ConsumerState(object):
+    # What the supervisor knows about the consumer of one queue. A queue is ready while it
+    # is consuming and, with MQRABBIT_STALLAFTER set, has seen a message that recently.
+    def __init__(self, id, stallafter=None):
+        self.id = id
+        self.state = 'starting'
+        self.since = time.time()
+        self.lastmessage = None
+        self.messages = 0
+        self.lag = None
+        self.reconnects = 0
+        self.lasterror = None
+        self.stallafter = stallafter
+
+    def setstate(self, state, error=None):
+        self.state = state
+        self.since = time.time()
+        if error is not None:
+            self.lasterror = str(error)
+        if state == 'reconnecting':
+            self.reconnects += 1
+            metrics.consumerreconnects.labels(self.id).inc()
+        metrics.consumerup.labels(self.id).set(1 if state == 'consuming' else 0)
+
+    def onmessage(self):
+        self.messages += 1
+        self.lastmessage = time.time()
+
+    def setlag(self, lag):
+        self.lag = lag
+        metrics.queuelag.labels(self.id).set(lag)
+
+    def ready(self, now):
+        if self.state != 'consuming':
+            return False
+        if self.stallafter and now - (self.lastmessage or self.since) > self.stallafter:
+            return False
+        return True
+
+    def asdict(self, now):
+        return {
+            'state': self.state,
+            'since': self.since,
+            'ready': self.ready(now),
+            'lastmessage': self.lastmessage,
+            'messages': self.messages,
+            'lag': self.lag,
+            'reconnects': self.reconnects,
+            'lasterror': self.lasterror
+        }
+
+workerhandler = None
+
+def initworker(id, settings, cachersettings):
+    # Runs in each worker process: rebuild the queue's handler with its own Valkey connection
+    global workerhandler
+    handlerlogger = getLogger(f"rabbitlistener.{id}")
+    cachemanager = ValkeyCacher(cachersettings)
+    cachemanager.configurecategory(id, settings)
+    if 'coalesce' in settings:
+        cachemanager = CoalescingCacher(cachemanager, **settings['coalesce'])
+    workerhandler = gethandlerclass(settings)(id, handlerlogger, cachemanager, settings)
+
+def handleinworker(method, properties, body):
+    started = time.perf_counter()
+    workerhandler.handlemessage(None, method, properties, body)
+    return time.perf_counter() - started
+
+class WorkerPool(object):
+    # Handles the messages of one queue on `size` single-worker executors, threads or
+    # processes. Messages are sharded on Handler.shardkey, so messages with the same key
+    # are handled in the order they were received.
+    # Worker processes are spawned, which imports the main module again; only ingest.py
+    # can survive that (app.py would set up the whole app per worker) and enables them.
+    allowprocesses = False
+
+    def __init__(self, id, handler, size, mode='thread', cachersettings=None):
+        self.id = id
+        self.handler = handler
+        self.mode = mode
+        self.cachersettings = cachersettings
+        self.lock = threading.Lock()
+        self.executors = [ self.createexecutor(index) for index in range(size) ]
+
+    def createexecutor(self, index):
+        if self.mode == 'process':
+            context = multiprocessing.get_context('spawn')
+            return ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=initworker,
+                                       initargs=(self.id, self.handler.settings, self.cachersettings))
+        return ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{self.id}-worker{index}")
+
+    def replaceexecutor(self, index, broken):
+        # A worker process that died (OOM kill, crash) breaks its executor for good, every
+        # later submit would fail. Only the first to notice replaces it.
+        with self.lock:
+            if self.executors[index] is not broken:
+                return
+            logger.warning("Worker %d of %s died, starting a new one", index, self.id)
+            self.executors[index] = self.createexecutor(index)
+        broken.shutdown(wait=False)
+
+    @classmethod
+    def fromsettings(cls, id, handler, settings, cachemanager, logger):
+        size = settings['MQRABBIT_WORKERS'] if 'MQRABBIT_WORKERS' in settings else 0
+        if size <= 0:
+            return None
+        mode = settings['MQRABBIT_WORKERMODE'] if 'MQRABBIT_WORKERMODE' in settings else 'thread'
+        cachersettings = cachemanager.connectionsettings()
+        if mode == 'process' and not cls.allowprocesses:
+            logger.warning("Worker processes are only available in ingest.py, using threads")
+            mode = 'thread'
+        if mode == 'process' and cachersettings is None:
+            logger.warning("Worker processes need a Valkey cache, using threads")
+            mode = 'thread'
+        logger.info(f"Handling messages with {size} worker {mode}s")
+        return cls(id, handler, size, mode, cachersettings)
+
+    def handle(self, method, properties, body):
+        started = time.perf_counter()
+        self.handler.handlemessage(None, method, properties, body)
+        return time.perf_counter() - started
+
+    def submit(self, method, properties, body, done):
+        # done(error, elapsed) is called from the worker once the message was handled. A
+        # body the handler cannot even key is failed right away, like a failing handler.
+        try:
+            key = self.handler.shardkey(body)
+        except Exception as exc:
+            done(exc, 0)
+            return
+        index = zlib.crc32(str(key).encode('utf-8')) % len(self.executors)
+        executor = self.executors[index]
+        try:
+            if self.mode == 'process':
+                # Only plain values can be sent to another process
+                method = SimpleNamespace(delivery_tag=method.delivery_tag, redelivered=method.redelivered,
+                                         exchange=method.exchange, routing_key=method.routing_key)
+                properties = SimpleNamespace(content_type=properties.content_type, headers=properties.headers) if properties is not None else None
+                future = executor.submit(handleinworker, method, properties, body)
+            else:
+                future = executor.submit(self.handle, method, properties, body)
+        except BrokenProcessPool as exc:
+            self.replaceexecutor(index, executor)
+            done(exc, 0)
+            return
+
+        def finished(future):
+            error = future.exception()
+            if isinstance(error, BrokenProcessPool):
+                self.replaceexecutor(index, executor)
+            done(error, future.result() if error is None else 0)
+        future.add_done_callback(finished)
+
 class QueueManager(object):
     def __init__(self, queue, settings, **kwargs):
         logger.debug(f"Created queuemanager with {kwargs}")
         self._queue = queue
-        self._settings = settings
+        # Keys starting with an underscore configure the manager itself, all others are queues
+        self._settings = { key: value for key, value in settings.items() if not key.startswith('_') }
+        self._options = { key[1:]: value for key, value in settings.items() if key.startswith('_') }
         
 
     def getsettings(self):
         return self._settings
+
+    def getoption(self, name, default=None):
+        return self._options[name] if name in self._options else default
     
     
 class Handler(object):
@@ -25,23 +321,36 @@ class Handler(object):
         self.cachemanager = cachemanager
         self.exchange = exchange
         self.settings = settings
-        self._channel = None
+        # Message bodies go to a separate logger so they can be switched off in logging.yaml,
+        # and only every payloadsample-th body is logged when it is on.
+        self.payloadlogger = getLogger(f"payload.{id}")
+        self.payloadsample = settings['payloadsample'] if 'payloadsample' in settings else 1
+        self.received = 0
+
+    def logpayload(self, description, body):
+        if not self.payloadlogger.isEnabledFor(logging.INFO):
+            return
+        self.received += 1
+        if self.received % self.payloadsample == 0:
+            self.payloadlogger.info("[%s] %s received %s", self.id, description, body)
 
     def handlemessage(self, ch, method, properties, body):
-        self.logger.info(f"Dropping {body}")
-        ch.basic_ack(delivery_tag = method.delivery_tag)
-
-    def openchannel(self):
-        if not self._channel:
-            mqrabbit_credentials = pika.PlainCredentials(self.settings['MQRABBIT_USER'], self.settings['MQRABBIT_PASSWORD'])
-            mqparameters = pika.ConnectionParameters(
-                host=self.settings['MQRABBIT_HOST'],
-                virtual_host=self.settings['MQRABBIT_VHOST'],
-                port=self.settings['MQRABBIT_PORT'],
-                credentials=mqrabbit_credentials)
-            mqconnection = pika.BlockingConnection(mqparameters)
-            self.channel = mqconnection.channel()
-        return self.channel
+        self.logpayload("Dropping", body)
+
+    # Handlers with asynchronous set also implement handlemessageasync, which the asyncio
+    # engine runs on its event loop with an asynccacher.AsyncValkeyCacher as cachemanager
+    asynchronous = False
+
+    def shardkey(self, body):
+        # Messages with the same key are handled in order by the same worker. The
+        # default keeps every message of the queue in order.
+        return None
+
+    def publish(self, body):
+        getpublisher(self.settings).publish(
+            exchange=self.settings['MQRABBIT_EXCHANGE'],
+            routing_key=self.settings['MQRABBIT_ROUTINGKEY'],
+            body=body)
 
 class LEDBoardHandler(Handler):
 
@@ -49,69 +358,102 @@ class LEDBoardHandler(Handler):
         super().__init__(id, logger, cachemanager, settings, exchange)
 
     def handlemessage(self, ch, method, properties, body):
-        self.logger.info(f"LEDBoard handler received {body}")
+        self.logpayload("LEDBoard handler", body)
 
         # LedBoard messages:
-        self.logger.debug(f" [{self.id}] Parsing")
         payload = json.loads(body)
-        self.logger.debug(f" [{self.id}] Parsed")
 
         if 'type' in payload and 'value' in payload:
             commandtype = payload['type']
             commandvalue = { 'value': payload['value'] }
-            self.logger.debug(f"  [{self.id}] Command = {commandtype}. Value = {commandvalue}")
+            self.logger.debug("  [%s] Command = %s. Value = %s", self.id, commandtype, commandvalue)
 
             self.cachemanager.updatecache(self.id, commandtype, commandvalue)
 
-        self.logger.info(f" [{self.id}] Done")
+        self.logger.debug(" [%s] Done", self.id)
+
+    asynchronous = True
+
+    async def handlemessageasync(self, ch, method, properties, body):
+        self.logpayload("LEDBoard handler", body)
+        payload = json.loads(body)
+        if 'type' in payload and 'value' in payload:
+            await self.cachemanager.updatecache(self.id, payload['type'], { 'value': payload['value'] })
+
+    def shardkey(self, body):
+        payload = json.loads(body)
+        return payload['type'] if isinstance(payload, dict) and 'type' in payload else None
 
     def post2exchange(self, value ):
         message = { 'type': 'active', 'value': value }
         self.logger.info(f"Posting to exchange: {value}")
-        self.openchannel().basic_publish(
-            exchange=self.settings['MQRABBIT_EXCHANGE'], 
-            routing_key=self.settings['MQRABBIT_ROUTINGKEY'], 
-            body=json.dumps(message))
+        self.publish(json.dumps(message))
 
     def setActiveState(self, active):
         self.logger.debug(f'Setting state to {active}')
         message = { 'type': 'active', 'value': active }
         self.logger.info(f"Posting to exchange: {message}")
-        self.openchannel().basic_publish(
-            exchange=self.settings['MQRABBIT_EXCHANGE'], 
-            routing_key=self.settings['MQRABBIT_ROUTINGKEY'], 
-            body=json.dumps(message))
+        self.publish(json.dumps(message))
 
 
 class RFC8428(Handler):
     def handlemessage(self, ch, method, properties, body):
-        self.logger.info(f"RFC 8428 handler received {body}")
+        self.logpayload("RFC 8428 handler", body)
 
         # RFC8428 Sensor measurement:
-        self.logger.debug(f" [{self.id}] Parsing")
         senml = json.loads(body)
-        self.logger.debug(f" [{self.id}] Parsed")
-        self.logger.debug(f"senml = {senml}")
-        ch.basic_ack(delivery_tag = method.delivery_tag)
-        bn = None
-        for message in senml:
-            self.logger.debug(f" [{self.id}] Handling message {message}")
-            if 'bn' in message:
-                bn = message['bn']
-                del message['bn']
-
-            if 'n' in message:
-                entryid = f"{bn}{message['n']}"
-                message['bn'] = bn
-                self.logger.debug(f" [{self.id}] Storing at {entryid}: {message}")
-                self.cachemanager.updatecache(self.id, entryid, message)
-        self.logger.info(f" [{self.id}] Done")
+        records = senmlrecords(senml)
+        self.logger.debug(" [%s] Storing %d records", self.id, len(records))
+        self.cachemanager.updatecachemany(self.id, records)
+        metrics.senmlrecords.labels(self.id).inc(len(records))
+        self.logger.debug(" [%s] Done", self.id)
+
+    asynchronous = True
+
+    async def handlemessageasync(self, ch, method, properties, body):
+        self.logpayload("RFC 8428 handler", body)
+        records = senmlrecords(json.loads(body))
+        self.logger.debug(" [%s] Storing %d records", self.id, len(records))
+        await self.cachemanager.updatecachemany(self.id, records)
+        metrics.senmlrecords.labels(self.id).inc(len(records))
+
+    def shardkey(self, body):
+        return senmlshardkey(json.loads(body))
+
+class DefaultHandler(Handler):
+    # Queues without a handler setting store their messages as SenML packs
+    def handlemessage(self, ch, method, properties, body):
+        self.logpayload("Default handler", body)
+
+        senml = json.loads(body)
+        records = senmlrecords(senml)
+        self.logger.debug(" [%s] Storing %d records", self.id, len(records))
+        self.cachemanager.updatecachemany(self.id, records)
+        self.logger.debug(" [%s] Done", self.id)
+
+    def shardkey(self, body):
+        return senmlshardkey(json.loads(body))
+
+    asynchronous = True
+
+    async def handlemessageasync(self, ch, method, properties, body):
+        self.logpayload("Default handler", body)
+        records = senmlrecords(json.loads(body))
+        self.logger.debug(" [%s] Storing %d records", self.id, len(records))
+        await self.cachemanager.updatecachemany(self.id, records)
+
+def gethandlerclass(settings):
+    return globals()[settings['handler']] if 'handler' in settings else DefaultHandler
 
 class RabbitListener(QueueManager):
     def __init__(self, cachemanager, **kwargs):
         super().__init__(**kwargs)
         self.cachemanager = cachemanager
         self.queues = {}
+        self.consumers = {}
+        self.threads = {}
+        for queueid in self._settings.keys():
+            self.cachemanager.configurecategory(queueid, self._settings[queueid])
 
     def start(self):
         logger.debug(f"Starting threads with {self._settings}")
@@ -119,10 +461,30 @@ class RabbitListener(QueueManager):
             queuesettings = self._settings[queueid]
 
             logger.info(f"Starting thread for {queueid}")
-            listener_thread = threading.Thread(target=self.readevents, kwargs={'settings': queuesettings, 'id':queueid})
+            self.consumerstate(queueid)
+            listener_thread = threading.Thread(target=self.readevents, kwargs={'settings': queuesettings, 'id':queueid},
+                                               name=f"rabbitlistener-{queueid}", daemon=True)
             listener_thread.start()
+            self.threads[queueid] = listener_thread
             logger.info("Thread started")
 
+    def consumerstate(self, queueid):
+        if queueid not in self.consumers:
+            settings = self._settings[queueid] if queueid in self._settings else {}
+            stallafter = settings['MQRABBIT_STALLAFTER'] if 'MQRABBIT_STALLAFTER' in settings else None
+            self.consumers[queueid] = ConsumerState(queueid, stallafter)
+        return self.consumers[queueid]
+
+    def status(self):
+        # alive: every consumer is still supervised, ready: every queue is consuming
+        now = time.time()
+        return {
+            'time': now,
+            'alive': all(thread.is_alive() for thread in self.threads.values()),
+            'ready': len(self.consumers) > 0 and all(state.ready(now) for state in self.consumers.values()),
+            'queues': { queueid: state.asdict(now) for queueid, state in self.consumers.items() }
+        }
+
     def getqueuehandler(self, queueid):
         logger.debug(f"Searching for handler for {queueid} in {self._settings}")
         if queueid in self.queues:
@@ -143,6 +505,64 @@ class RabbitListener(QueueManager):
             self.queues[queueid] = self
             return self
 
+    def completer(self, id, acknowledger, logger):
+        # Ack only after the handler completed; a failing message is requeued once
+        # and dropped when it fails again on redelivery.
+        acked = metrics.messagesacked.labels(id)
+        failed = metrics.messagesfailed.labels(id)
+        latency = metrics.handlerlatency.labels(id)
+
+        def complete(method, error, elapsed, generation):
+            latency.observe(elapsed)
+            if not acknowledger.current(generation):
+                logger.debug("Dropping completion of message %s from a closed channel", method.delivery_tag)
+                return
+            if error is not None:
+                failed.inc()
+                logger.error("Handler failed for message %s: %s", method.delivery_tag, error, exc_info=error)
+                acknowledger.nack(method.delivery_tag, requeue=not method.redelivered)
+                return
+            acked.inc()
+            acknowledger.ack(method.delivery_tag)
+        return complete
+
+    def dispatcher(self, id, handler, acknowledger, logger, pool=None, threadsafe=None):
+        # With a worker pool the handler runs elsewhere and the ack is scheduled back
+        # on the connection's thread with threadsafe(callback).
+        consumed = metrics.messagesconsumed.labels(id)
+        state = self.consumerstate(id)
+        complete = self.completer(id, acknowledger, logger)
+
+        def dispatch(ch, method, properties, body):
+            consumed.inc()
+            state.onmessage()
+            generation = acknowledger.generation
+            if pool is not None:
+                def done(error, elapsed):
+                    try:
+                        threadsafe(lambda: complete(method, error, elapsed, generation))
+                    except Exception as exc:
+                        # The connection is gone, the broker redelivers the message
+                        logger.warning("Unable to acknowledge message %s: %s", method.delivery_tag, exc)
+                pool.submit(method, properties, body, done)
+                return
+            started = time.perf_counter()
+            try:
+                handler.handlemessage(ch, method, properties, body)
+            except Exception as exc:
+                complete(method, exc, time.perf_counter() - started, generation)
+                return
+            complete(method, None, time.perf_counter() - started, generation)
+        return dispatch
+
+    def createhandler(self, id, settings, logger):
+        handlerclass = gethandlerclass(settings)
+        logger.debug(f"handlerclass = {handlerclass}")
+        cachemanager = self.cachemanager
+        if 'coalesce' in settings:
+            cachemanager = CoalescingCacher(cachemanager, **settings['coalesce'])
+        return handlerclass(id, logger, cachemanager, settings)
+
     def getposthandler(self, queueid, mapping):
         logger.debug(f"Finding post handler for {queueid} and {mapping}")
 
@@ -150,33 +570,29 @@ class RabbitListener(QueueManager):
         h = getattr(queuehandler, mapping['handlermethod']['name'])
         return h
 
-    def handlemessage(self, ch, method, properties, body):
-        logger.info(f"default handler received {body}")
-
-        # RFC8428 Sensor measurement:
-        logger.debug(f" [{id}] Parsing")
-        senml = json.loads(body)
-        logger.debug(f" [{id}] Parsed")
-        logger.debug(f"senml = {senml}")
-        ch.basic_ack(delivery_tag = method.delivery_tag)
-        bn = None
-        for message in senml:
-            logger.debug(f" [{id}] Handling message {message}")
-            if 'bn' in message:
-                bn = message['bn']
-                del message['bn']
-
-            if 'n' in message:
-                entryid = f"{bn}{message['n']}"
-                message['bn'] = bn
-                logger.debug(f" [{id}] Storing at {entryid}: {message}")
-                self.cachemanager.updatecache(id, entryid, message)
-        logger.info(f" [{id}] Done")
-
 
     def readevents(self, settings, id):
+        # Supervises the consumer of one queue: whenever the connection or channel fails
+        # it reconnects after a jittered exponential backoff, with a new exclusive queue.
         logger = getLogger(f"rabbitlistener.{id}")
+        state = self.consumerstate(id)
+        backoff = Backoff.fromsettings(settings)
+        handler = self.createhandler(id, settings, logger)
+        pool = WorkerPool.fromsettings(id, handler, settings, self.cachemanager, logger)
 
+        while True:
+            try:
+                self.consume(settings, id, handler, pool, state, backoff, logger)
+                error = "Consumer stopped"
+            except Exception as exc:
+                error = exc
+            delay = backoff.next()
+            logger.warning(f"Consuming {id} failed ({error}), reconnecting in {delay:.1f}s")
+            state.setstate('reconnecting', error)
+            sleep(delay)
+
+    def consume(self, settings, id, handler, pool, state, backoff, logger):
+        state.setstate('connecting')
         mqrabbit_credentials = pika.PlainCredentials(settings['MQRABBIT_USER'], settings['MQRABBIT_PASSWORD'])
         mqparameters = pika.ConnectionParameters(
             host=settings['MQRABBIT_HOST'],
@@ -184,30 +600,50 @@ class RabbitListener(QueueManager):
             port=settings['MQRABBIT_PORT'],
             credentials=mqrabbit_credentials)
         mqconnection = pika.BlockingConnection(mqparameters)
-        channel = mqconnection.channel()
-        #channel.exchange_declare(exchange=settings['MQRABBIT_EXCHANGE'])
-
-        queuename = f"rabbitlistener-{id}-{secrets.token_hex(10)}"
-        result = channel.queue_declare(queue=queuename, exclusive=True, auto_delete=True )
-
-        routing_key = settings['MQRABBIT_ROUTINGKEY'] if 'MQRABBIT_ROUTINGKEY' in settings else ""
-        exchange = settings['MQRABBIT_EXCHANGE'] if 'MQRABBIT_EXCHANGE' in settings else ""
-
-        logger.info(f"Binding queue to exchange: [{exchange}]")
-
-        channel.queue_bind(exchange=exchange, queue=result.method.queue, routing_key=routing_key)
-
-        if 'handler' in settings:
-            handlerclass = globals()[settings['handler']]
-            logger.debug(f"handlerclass = {handlerclass}")
-            handler = handlerclass(id, logger, self.cachemanager, settings)
-        else:
-            handler = self
-
-        channel.basic_consume(queue=result.method.queue, on_message_callback=handler.handlemessage)
-        logger.info("Waiting for messages")
-        channel.start_consuming()
-
-        while True:
-            logger.info(f"Sleeping {settings}")
-            sleep(10)
+        try:
+            channel = mqconnection.channel()
+            #channel.exchange_declare(exchange=settings['MQRABBIT_EXCHANGE'])
+
+            queuename = f"rabbitlistener-{id}-{secrets.token_hex(10)}"
+            result = channel.queue_declare(queue=queuename, exclusive=True, auto_delete=True )
+
+            routing_key = settings['MQRABBIT_ROUTINGKEY'] if 'MQRABBIT_ROUTINGKEY' in settings else ""
+            exchange = settings['MQRABBIT_EXCHANGE'] if 'MQRABBIT_EXCHANGE' in settings else ""
+
+            logger.info(f"Binding queue to exchange: [{exchange}]")
+
+            channel.queue_bind(exchange=exchange, queue=result.method.queue, routing_key=routing_key)
+
+            acknowledger = Acknowledger.fromsettings(channel, mqconnection.call_later, settings, logger)
+
+            channel.basic_qos(prefetch_count=prefetchcount(settings, logger))
+            channel.basic_consume(queue=result.method.queue,
+                                  on_message_callback=self.dispatcher(id, handler, acknowledger, logger, pool, mqconnection.add_callback_threadsafe))
+
+            laginterval = settings['MQRABBIT_LAGINTERVAL'] if 'MQRABBIT_LAGINTERVAL' in settings else 15
+            def checklag():
+                # Messages waiting in the queue, not counting the prefetched ones
+                declared = channel.queue_declare(queue=result.method.queue, passive=True)
+                state.setlag(declared.method.message_count)
+                mqconnection.call_later(laginterval, checklag)
+            checklag()
+
+            state.setstate('consuming')
+            backoff.reset()
+            logger.info("Waiting for messages")
+            channel.start_consuming()
+        finally:
+            if mqconnection.is_open:
+                try:
+                    mqconnection.close()
+                except Exception:
+                    pass
+
+
+def createlistener(cachemanager, queue, settings):
+    engine = settings['_engine'] if '_engine' in settings else 'thread'
+    logger.info(f"Using {engine} consumer engine")
+    if engine == 'asyncio':
+        from asynclistener import AsyncRabbitListener
+        return AsyncRabbitListener(cachemanager, queue=queue, settings=settings)
+    return RabbitListener(cachemanager, queue=queue, settings=settings)
@@ -0,0 +1,120 @@
+from types import SimpleNamespace
+from logging import getLogger
+
+from rabbitlistener import Acknowledger, RabbitListener
+
+class RecordingChannel(object):
+    def __init__(self):
+        self.calls = []
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.calls.append(('ack', delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.calls.append(('nack', delivery_tag, requeue))
+
+def acknowledger(batchsize):
+    channel = RecordingChannel()
+    timers = []
+    return Acknowledger(channel, lambda delay, callback: timers.append(callback), batchsize=batchsize), channel, timers
+
+def test_unbatched_acks_each_delivery():
+    ack, channel, timers = acknowledger(1)
+    ack.ack(2)
+    ack.ack(1)
+    assert channel.calls == [ ('ack', 2, False), ('ack', 1, False) ]
+    assert timers == []
+
+def test_batch_acks_up_to_the_last_delivery():
+    ack, channel, timers = acknowledger(3)
+    for tag in (1, 2, 3):
+        ack.ack(tag)
+    assert channel.calls == [ ('ack', 3, True) ]
+    assert ack.watermark == 3
+
+def test_out_of_order_completions_wait_for_the_gap():
+    ack, channel, timers = acknowledger(3)
+    ack.ack(2)
+    ack.ack(3)
+    ack.flush()
+    assert channel.calls == []
+    assert ack.watermark == 0
+    ack.ack(1)
+    assert channel.calls == [ ('ack', 3, True) ]
+    assert ack.settled == {}
+
+def test_batch_stops_below_an_unfinished_delivery():
+    ack, channel, timers = acknowledger(10)
+    for tag in (1, 2, 4, 5):
+        ack.ack(tag)
+    ack.flush()
+    assert channel.calls == [ ('ack', 2, True) ]
+    ack.ack(3)
+    ack.flush()
+    assert channel.calls == [ ('ack', 2, True), ('ack', 5, True) ]
+
+def test_timer_flushes_a_partial_batch():
+    ack, channel, timers = acknowledger(10)
+    ack.ack(1)
+    ack.ack(2)
+    assert len(timers) == 1
+    timers[0]()
+    assert channel.calls == [ ('ack', 2, True) ]
+    assert not ack.timerset
+
+def test_nack_is_never_covered_by_a_batch():
+    ack, channel, timers = acknowledger(10)
+    ack.ack(1)
+    ack.nack(2, requeue=True)
+    ack.ack(3)
+    ack.flush()
+    assert channel.calls == [ ('ack', 1, True), ('nack', 2, True), ('ack', 3, True) ]
+
+def test_nack_first_leaves_nothing_to_ack():
+    ack, channel, timers = acknowledger(10)
+    ack.nack(1, requeue=False)
+    ack.flush()
+    assert channel.calls == [ ('nack', 1, False) ]
+    assert ack.watermark == 1
+
+def test_reset_restarts_the_watermark():
+    ack, channel, timers = acknowledger(10)
+    ack.ack(1)
+    ack.ack(3)
+    ack.reset()
+    ack.flush()
+    assert channel.calls == []
+    # The reopened channel numbers its deliveries from 1 again
+    ack.ack(1)
+    ack.ack(2)
+    ack.flush()
+    assert channel.calls == [ ('ack', 2, True) ]
+
+def test_reset_invalidates_earlier_generations():
+    ack, channel, timers = acknowledger(10)
+    generation = ack.generation
+    assert ack.current(generation)
+    ack.reset()
+    assert not ack.current(generation)
+    assert ack.current(ack.generation)
+
+class DeferredPool(object):
+    def __init__(self):
+        self.done = []
+
+    def submit(self, method, properties, body, done):
+        self.done.append(done)
+
+def test_completions_from_a_closed_channel_are_dropped():
+    ack, channel, timers = acknowledger(1)
+    pool = DeferredPool()
+    listener = RabbitListener(SimpleNamespace(configurecategory=lambda categoryid, settings: None), queue=None, settings={})
+    dispatch = listener.dispatcher('test', None, ack, getLogger('test'), pool, lambda callback: callback())
+    for tag in (1, 2):
+        dispatch(channel, SimpleNamespace(delivery_tag=tag, redelivered=False), None, b'[]')
+    pool.done[0](None, 0)
+    ack.reset()
+    pool.done[1](None, 0)
+    dispatch(channel, SimpleNamespace(delivery_tag=1, redelivered=False), None, b'[]')
+    pool.done[2](None, 0)
+    assert channel.calls == [ ('ack', 1, False), ('ack', 1, False) ]
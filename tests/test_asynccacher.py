@@ -0,0 +1,100 @@
+import asyncio
+import json
+from types import SimpleNamespace
+from logging import getLogger
+
+import pytest
+import valkey
+import valkey.asyncio
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from cacher import ValkeyCacher
+from asynccacher import AsyncValkeyCacher
+from asynclistener import AsyncRabbitListener
+from rabbitlistener import Acknowledger, RFC8428
+
+SETTINGS = { 'host': 'localhost', 'port': 6379, 'user': 'u', 'token': 't', 'prefix': 'test' }
+
+class RecordingChannel(object):
+    def __init__(self):
+        self.calls = []
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.calls.append(('ack', delivery_tag))
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.calls.append(('nack', delivery_tag))
+
+@pytest.fixture
+def cachers(monkeypatch):
+    # Both cachers talk to the same fake server, so writes of one are read by the other
+    server = fakeredis.FakeServer()
+    syncconnection = fakeredis.FakeValkey(server=server)
+    asyncconnection = fakeredis.FakeAsyncValkey(server=server)
+    monkeypatch.setattr(valkey, 'Valkey', lambda connection_pool: syncconnection)
+    monkeypatch.setattr(valkey.asyncio, 'Valkey', lambda connection_pool: asyncconnection)
+    return ValkeyCacher(dict(SETTINGS)), AsyncValkeyCacher(dict(SETTINGS))
+
+def test_writes_are_read_by_the_synchronous_cacher(cachers):
+    sync, asynccacher = cachers
+    asynccacher.configurecategory('sensors', { 'history': {} })
+
+    async def write():
+        await asynccacher.updatecachemany('sensors', [ ('a', { 'v': 1 }), ('b', { 'v': 2 }) ])
+        await asynccacher.updatecache('sensors', 'a', { 'v': 3 })
+        return await asynccacher.getentry('sensors', 'a'), await asynccacher.getentrymeta('sensors', 'a')
+    entry, meta = asyncio.run(write())
+
+    assert entry['v'] == 3
+    assert sync.getentry('sensors', 'a')['v'] == 3
+    assert sync.getentrymeta('sensors', 'a') == meta
+    assert sorted(sync.listentries('sensors')) == [ 'a', 'b' ]
+    assert len(sync.gethistory('sensors', 'a')) == 2
+
+def test_writes_evict_beyond_maxentries(cachers):
+    sync, asynccacher = cachers
+    asynccacher.configurecategory('sensors', { 'maxentries': 2 })
+
+    async def write():
+        for entryid in ('a', 'b', 'c'):
+            await asynccacher.updatecache('sensors', entryid, { 'v': entryid })
+        return await asynccacher.listentries('sensors')
+
+    assert sorted(asyncio.run(write())) == [ 'b', 'c' ]
+    assert sync.getentry('sensors', 'a') is None
+
+def test_handler_messages_are_stored_in_order_and_acked(cachers):
+    sync, asynccacher = cachers
+    listener = AsyncRabbitListener(sync, queue=None, settings={ 'sensors': {} })
+    handler = RFC8428('sensors', getLogger('test'), asynccacher, {})
+    channel = RecordingChannel()
+
+    async def consume():
+        listener.loop = asyncio.get_running_loop()
+        acknowledger = Acknowledger(channel, listener.loop.call_later)
+        dispatch = listener.asyncdispatcher('sensors', handler, acknowledger, getLogger('test'))
+        for tag, value in ((1, 1), (2, 2), (3, 3)):
+            method = SimpleNamespace(delivery_tag=tag, redelivered=False)
+            dispatch(channel, method, None, json.dumps([ { 'bn': 'room:', 'n': 'temp', 'v': value } ]))
+        dispatch(channel, SimpleNamespace(delivery_tag=4, redelivered=False), None, b'not json')
+        while len(channel.calls) < 4:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(consume())
+    assert channel.calls == [ ('ack', 1), ('ack', 2), ('ack', 3), ('nack', 4) ]
+    assert sync.getentry('sensors', 'room:temp')['v'] == 3
+
+def test_entry_and_meta_are_read_together_from_either_layout(cachers):
+    sync, asynccacher = cachers
+    sync.updatecache('sensors', 'string', { 'v': 1 })
+    sync.hashstorage = True
+    sync.updatecache('sensors', 'hash', { 'v': 2 })
+
+    for entryid, expected in (('string', 1), ('hash', 2)):
+        value, meta = sync.getentrywithmeta('sensors', entryid)
+        assert value['v'] == expected
+        assert meta == sync.getentrymeta('sensors', entryid)
+        value, meta = asyncio.run(asynccacher.getentrywithmeta('sensors', entryid))
+        assert value['v'] == expected
+    assert sync.getentrywithmeta('sensors', 'missing') == (None, None)
@@ -0,0 +1,89 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import cacher
+from cacher import BaseCacher, CoalescingCacher
+
+class RecordingCacher(BaseCacher):
+    def __init__(self):
+        self.written = []
+        self.failing = False
+
+    def updatecache(self, categoryid, entryid, entry):
+        return self.updatecachemany(categoryid, [ (entryid, entry) ])[0][1]
+
+    def updatecachemany(self, categoryid, entries):
+        if self.failing:
+            raise ConnectionError("backend unavailable")
+        self.written.extend((categoryid, entryid, entry['v']) for entryid, entry in entries)
+        return [ (entryid, True) for entryid, entry in entries ]
+
+    def getentry(self, categoryid, entryid):
+        return None
+
+    def listentries(self, categoryid, since=None, start=0, count=None):
+        return []
+
+    def listcategories(self):
+        return []
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Only the coalescing decisions see this clock, the flusher thread still sleeps for real
+    clock = SimpleNamespace(now=1000.0, sleep=time.sleep, monotonic=time.monotonic)
+    clock.time = lambda: clock.now
+    monkeypatch.setattr(cacher, 'time', clock)
+    return clock
+
+def test_unchanged_value_is_skipped_until_refresh(clock):
+    backend = RecordingCacher()
+    coalescing = CoalescingCacher(backend, refresh=60)
+    coalescing.updatecache('sensors', 'a', { 'v': 1 })
+    clock.now += 30
+    coalescing.updatecache('sensors', 'a', { 'v': 1 })
+    assert backend.written == [ ('sensors', 'a', 1) ]
+    clock.now += 31
+    coalescing.updatecache('sensors', 'a', { 'v': 1 })
+    assert backend.written == [ ('sensors', 'a', 1), ('sensors', 'a', 1) ]
+    assert coalescing.stats() == { 'received': 3, 'written': 2, 'pending': 0 }
+
+def test_ignored_fields_do_not_count_as_a_change(clock):
+    backend = RecordingCacher()
+    coalescing = CoalescingCacher(backend, refresh=60, ignore=('t',))
+    coalescing.updatecache('sensors', 'a', { 'v': 1, 't': 1 })
+    clock.now += 1
+    coalescing.updatecache('sensors', 'a', { 'v': 1, 't': 2 })
+    assert backend.written == [ ('sensors', 'a', 1) ]
+    clock.now += 1
+    coalescing.updatecache('sensors', 'a', { 'v': 2, 't': 3 })
+    assert backend.written == [ ('sensors', 'a', 1), ('sensors', 'a', 2) ]
+
+def test_latest_value_wins_within_mininterval(clock):
+    backend = RecordingCacher()
+    coalescing = CoalescingCacher(backend, refresh=60, mininterval=10)
+    coalescing.updatecache('sensors', 'a', { 'v': 1 })
+    for value in (2, 3):
+        clock.now += 1
+        coalescing.updatecache('sensors', 'a', { 'v': value })
+    assert backend.written == [ ('sensors', 'a', 1) ]
+    assert coalescing.stats()['pending'] == 1
+    clock.now += 9
+    coalescing.flush()
+    assert backend.written == [ ('sensors', 'a', 1), ('sensors', 'a', 3) ]
+    assert coalescing.stats()['pending'] == 0
+
+def test_failed_write_stays_pending(clock):
+    backend = RecordingCacher()
+    coalescing = CoalescingCacher(backend, refresh=60)
+    backend.failing = True
+    with pytest.raises(ConnectionError):
+        coalescing.updatecache('sensors', 'a', { 'v': 1 })
+    assert coalescing.state == {}
+    assert coalescing.stats() == { 'received': 1, 'written': 0, 'pending': 1 }
+    backend.failing = False
+    coalescing.flush()
+    assert backend.written == [ ('sensors', 'a', 1) ]
+    assert coalescing.state[('sensors', 'a')]['written'] == clock.now
+    assert coalescing.stats()['pending'] == 0
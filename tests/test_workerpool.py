@@ -0,0 +1,71 @@
+import threading
+from types import SimpleNamespace
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from logging import getLogger
+
+from rabbitlistener import Handler, WorkerPool
+
+class RecordingHandler(Handler):
+    def __init__(self):
+        super().__init__('test', getLogger('test'), None, {})
+        self.handled = []
+
+    def handlemessage(self, ch, method, properties, body):
+        self.handled.append(method.delivery_tag)
+
+class BrokenOnSubmit(object):
+    # What a ProcessPoolExecutor does after its worker process died
+    def __init__(self):
+        self.shutdowns = 0
+
+    def submit(self, *args):
+        raise BrokenProcessPool("A child process terminated abruptly")
+
+    def shutdown(self, wait=True):
+        self.shutdowns += 1
+
+class BrokenWhileHandling(BrokenOnSubmit):
+    # The worker died while handling an already submitted message
+    def submit(self, *args):
+        future = Future()
+        future.set_exception(BrokenProcessPool("A child process terminated abruptly"))
+        return future
+
+def submit(pool, tag):
+    finished = threading.Event()
+    result = {}
+    def done(error, elapsed):
+        result['error'] = error
+        finished.set()
+    pool.submit(SimpleNamespace(delivery_tag=tag, redelivered=False), None, b'[]', done)
+    assert finished.wait(5)
+    return result['error']
+
+def test_broken_executor_is_replaced_on_submit():
+    handler = RecordingHandler()
+    pool = WorkerPool('test', handler, 1)
+    broken = pool.executors[0] = BrokenOnSubmit()
+    assert isinstance(submit(pool, 1), BrokenProcessPool)
+    assert pool.executors[0] is not broken
+    assert broken.shutdowns == 1
+    assert submit(pool, 2) is None
+    assert handler.handled == [ 2 ]
+
+def test_broken_executor_is_replaced_when_a_message_fails():
+    handler = RecordingHandler()
+    pool = WorkerPool('test', handler, 1)
+    broken = pool.executors[0] = BrokenWhileHandling()
+    assert isinstance(submit(pool, 1), BrokenProcessPool)
+    assert pool.executors[0] is not broken
+    assert submit(pool, 2) is None
+    assert handler.handled == [ 2 ]
+
+def test_handler_errors_keep_the_executor():
+    class FailingHandler(RecordingHandler):
+        def handlemessage(self, ch, method, properties, body):
+            raise ValueError("bad message")
+    pool = WorkerPool('test', FailingHandler(), 1)
+    executor = pool.executors[0]
+    assert isinstance(submit(pool, 1), ValueError)
+    assert pool.executors[0] is executor
@@ -0,0 +1,68 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from config import loadsettings
+
+AuthenticatedUser = namedtuple('AuthenticatedUser', [ 'id', 'roles' ])
+
+def hashtoken(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+class TokenTable(object):
+    # Immutable sha256(token) -> AuthenticatedUser table. Only token hashes are kept, users
+    # may configure 'tokenhash' instead of 'token' so plain tokens need not be in the config.
+    # With reloadinterval > 0 the users section is reloaded when the config file changes.
+    def __init__(self, users, reloadinterval=0):
+        self.logger = logging.getLogger(__name__)
+        self.reloadinterval = reloadinterval
+        self.configfile = os.getenv("CACHECONFIG")
+        self.mtime = self.getmtime()
+        self.nextcheck = time.monotonic() + reloadinterval
+        self.reloadlock = threading.Lock()
+        self.table = self.build(users)
+
+    def build(self, users):
+        table = {}
+        for userinfo in users:
+            digest = userinfo['tokenhash'] if 'tokenhash' in userinfo else hashtoken(userinfo['token'])
+            roles = frozenset(userinfo['roles'] if 'roles' in userinfo else ())
+            digest = bytes.fromhex(digest)
+            table[digest] = AuthenticatedUser(userinfo['id'], roles)
+        self.logger.info(f"Loaded {len(table)} users")
+        return MappingProxyType(table)
+
+    def getmtime(self):
+        try:
+            return os.stat(self.configfile).st_mtime if self.configfile else None
+        except OSError:
+            return None
+
+    def reloadifchanged(self):
+        now = time.monotonic()
+        if now < self.nextcheck or not self.reloadlock.acquire(blocking=False):
+            return
+        try:
+            self.nextcheck = now + self.reloadinterval
+            mtime = self.getmtime()
+            if mtime is None or mtime == self.mtime:
+                return
+            self.mtime = mtime
+            # Swapping the reference is atomic, lookups see either the old or the new table
+            self.table = self.build(loadsettings()['users'])
+        except Exception:
+            self.logger.exception("Reloading users failed, keeping the current users")
+        finally:
+            self.reloadlock.release()
+
+    def lookup(self, token):
+        if self.reloadinterval:
+            self.reloadifchanged()
+        digest = hashlib.sha256(token.encode('utf-8')).digest()
+        # Keyed by the hash, the plain token never reaches the dict comparison
+        table = self.table
+        return table[digest] if digest in table else None